@@ -6,12 +6,15 @@
 
 import asyncio
 import functools
+import inspect
 import logging
-import time
-from typing import Any, Callable, Coroutine, Dict, TypeVar, cast
+import re
+from typing import Any, Callable, Coroutine, Dict, List, NamedTuple, Optional, Sequence, Tuple, TypeVar, cast
 
+import instrument
 import motor
-from data import SensorData
+from data import EDGE_INTERVALS, SensorData
+from sensor import wait_any
 
 LOG = logging.getLogger("Control")
 
@@ -36,10 +39,110 @@ STEP_BACK_MAX = 1300 # Full Extension
 STATES = {} # type: Dict[str, str]
 SLEEP = 0.1
 
+# How far ahead (in seconds) to extrapolate the lifting mechanisms' encoders,
+# so we stop them before they overshoot a target rather than after.
+STOP_LEAD = 0.05
+
 StateF = TypeVar('StateF', bound=Callable[..., None])
 
 ProgressCallback = Callable[[str], None]
 
+class CommandError(ValueError):
+    """Raised when a command is unknown or given invalid arguments."""
+
+class Parameter(NamedTuple("Parameter", [("name", str), ("convert", Callable[[str], Any]), ("default", Any)])):
+    """An argument which a client may pass to a command."""
+
+class Command(NamedTuple("Command", [
+        ("name", str), ("func", Callable[..., Any]), ("params", List[Parameter]),
+        ("data", bool), ("callback", bool), ("routine", bool)])):
+    """A command which clients may run, along with how to call it.
+
+       `data` and `callback` are set if the function takes the sensor data or
+       progress callback, which are passed by keyword. Routines are coroutine
+       functions, which should be run by a `routine.Supervisor`.
+    """
+
+    def bind(self, args: Sequence[str], data: SensorData,
+             callback: ProgressCallback) -> Callable[[], Any]:
+        """Convert the given arguments, returning a function which runs this
+           command with them.
+        """
+        if len(args) > len(self.params):
+            raise CommandError("%s takes at most %d arguments" % (self.name, len(self.params)))
+
+        values = [] # type: List[Any]
+        for i, param in enumerate(self.params):
+            if i < len(args):
+                try:
+                    values.append(param.convert(args[i]))
+                except ValueError:
+                    raise CommandError("Invalid %s for %s: %s" % (param.name, self.name, args[i])) from None
+            elif param.default is inspect.Parameter.empty:
+                raise CommandError("%s requires %s" % (self.name, param.name))
+            else:
+                values.append(param.default)
+
+        kwargs = {} # type: Dict[str, Any]
+        if self.data:
+            kwargs["data"] = data
+        if self.callback:
+            kwargs["callback"] = callback
+        return functools.partial(self.func, *values, **kwargs)
+
+# Every command clients may run, by name.
+COMMANDS = {} # type: Dict[str, Command]
+
+# The most words in any command's name, when split on "_".
+_COMMAND_WORDS = 1
+
+_COMMAND_NAME = re.compile("^[a-z][a-z0-9]*(_[a-z0-9]+)*$")
+
+CommandF = TypeVar('CommandF', bound=Callable[..., Any])
+
+def command(func: CommandF) -> CommandF:
+    """A decorator, which registers a function as a command that clients may run.
+
+       Any parameters other than `data` and `callback` are arguments clients may
+       pass, converted using their annotation (float, int or str).
+    """
+    global _COMMAND_WORDS # pylint: disable=global-statement
+
+    name = func.__name__
+    if not _COMMAND_NAME.match(name):
+        raise ValueError("Invalid command name %s" % name)
+    if name in COMMANDS:
+        raise ValueError("Command %s is already registered" % name)
+
+    params = []
+    inject = set()
+    for param in inspect.signature(func).parameters.values():
+        if param.name in ("data", "callback"):
+            inject.add(param.name)
+        elif param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+            convert = param.annotation
+            if convert not in (float, int, str):
+                raise ValueError("Cannot convert %s for command %s" % (param.name, name))
+            params.append(Parameter(param.name, convert, param.default))
+        else:
+            raise ValueError("Unsupported parameter %s for command %s" % (param.name, name))
+
+    COMMANDS[name] = Command(name, func, params, "data" in inject, "callback" in inject,
+                             asyncio.iscoroutinefunction(func))
+    _COMMAND_WORDS = max(_COMMAND_WORDS, name.count("_") + 1)
+    return func
+
+def find_command(words: Sequence[str]) -> Tuple[Optional[Command], Sequence[str]]:
+    """Find the command named by the start of a message, returning it and its
+       arguments. The app sends names with spaces ("Lift Both"), so we take the
+       longest run of words which names a command.
+    """
+    for count in range(min(len(words), _COMMAND_WORDS), 0, -1):
+        found = COMMANDS.get("_".join(words[:count]))
+        if found is not None:
+            return found, words[count:]
+    return None, words
+
 def state(*machines: str) -> Callable[[StateF], StateF]:
     """A decorator, which only applies the underlying function if the given machines
        are not already in this state.
@@ -71,6 +174,13 @@ def state(*machines: str) -> Callable[[StateF], StateF]:
 
     return decorator
 
+def brake() -> None:
+    """Stop all motors, whatever state we believe they are in."""
+    for machine in STATES:
+        STATES[machine] = "stop"
+    motor.stop_motors()
+
+@command
 @state("step_front", "step_back", "drive")
 def stop() -> None:
 
@@ -84,102 +194,159 @@ def stop() -> None:
     LOG.info("Stopping motors")
     motor.stop_motors()
 
+@command
 @state("drive")
 def forward() -> None:
     """Move Spencer forwards."""
-    motor.set_motor(DRIVE_LEFT, DRIVE_SIDE_FWD)
-    motor.set_motor(DRIVE_RIGHT, DRIVE_SIDE_BCK)
-    motor.set_motor(DRIVE_BACK, DRIVE_SIDE_FWD)
-    motor.set_motor(DRIVE_FWD, DRIVE_SIDE_FWD)
+    with motor.MotorFrame():
+        motor.set_motor(DRIVE_LEFT, DRIVE_SIDE_FWD)
+        motor.set_motor(DRIVE_RIGHT, DRIVE_SIDE_BCK)
+        motor.set_motor(DRIVE_BACK, DRIVE_SIDE_FWD)
+        motor.set_motor(DRIVE_FWD, DRIVE_SIDE_FWD)
 
+@command
 @state("drive")
 def stop_forward() -> None:
     """Stop Spencer moving forwards."""
-    motor.stop_motor(DRIVE_LEFT)
-    motor.stop_motor(DRIVE_RIGHT)
-    motor.stop_motor(DRIVE_BACK)
-    motor.stop_motor(DRIVE_FWD)
+    with motor.MotorFrame():
+        motor.stop_motor(DRIVE_LEFT)
+        motor.stop_motor(DRIVE_RIGHT)
+        motor.stop_motor(DRIVE_BACK)
+        motor.stop_motor(DRIVE_FWD)
 
+@command
 @state("drive")
 def backward() -> None:
     """Move Spencer backwards."""
-    motor.set_motor(DRIVE_LEFT, DRIVE_SIDE_BCK)
-    motor.set_motor(DRIVE_RIGHT, DRIVE_SIDE_FWD)
-    motor.set_motor(DRIVE_BACK, DRIVE_SIDE_BCK)
-    motor.set_motor(DRIVE_FWD, DRIVE_SIDE_BCK)
+    with motor.MotorFrame():
+        motor.set_motor(DRIVE_LEFT, DRIVE_SIDE_BCK)
+        motor.set_motor(DRIVE_RIGHT, DRIVE_SIDE_FWD)
+        motor.set_motor(DRIVE_BACK, DRIVE_SIDE_BCK)
+        motor.set_motor(DRIVE_FWD, DRIVE_SIDE_BCK)
 
+@command
 @state("drive")
 def turn_left(speed: float = 1.0) -> None:
     """Attempt to turn Spencer left. It's a sight for sore eyes."""
-    motor.set_motor(DRIVE_LEFT, int(DRIVE_SIDE_FWD * speed)) # TODO: Fix this so it's actually bloody correct.
-    motor.set_motor(DRIVE_RIGHT, int(DRIVE_SIDE_FWD * speed))
+    with motor.MotorFrame():
+        motor.set_motor(DRIVE_LEFT, int(DRIVE_SIDE_FWD * speed)) # TODO: Fix this so it's actually bloody correct.
+        motor.set_motor(DRIVE_RIGHT, int(DRIVE_SIDE_FWD * speed))
 
+@command
 @state("drive")
 def turn_right(speed: float = 1.0) -> None:
     """Attempt to turn Spencer right. It's not very effective."""
-    motor.set_motor(DRIVE_LEFT, int(DRIVE_SIDE_BCK * speed))
-    motor.set_motor(DRIVE_RIGHT, int(DRIVE_SIDE_BCK * speed))
-
+    with motor.MotorFrame():
+        motor.set_motor(DRIVE_LEFT, int(DRIVE_SIDE_BCK * speed))
+        motor.set_motor(DRIVE_RIGHT, int(DRIVE_SIDE_BCK * speed))
+
+@command
+def drive(speed: float = 1.0, turn: float = 0.0) -> None:
+    """Drive Spencer at `speed` (from -1, full speed backwards, to 1) while
+       turning (from -1, full speed left, to 1). Unlike the other drive
+       commands this is sent every time, so it can be used for continuous
+       control. Motors whose speed is unchanged are skipped by the frame.
+    """
+    # Leave some room for turning while driving, rather than clipping it.
+    scale = max(1.0, abs(speed) + abs(turn))
+    speed, turn = speed / scale, turn / scale
+
+    STATES["drive"] = "drive"
+    with motor.MotorFrame():
+        motor.set_motor(DRIVE_LEFT, int(DRIVE_SIDE_FWD * (speed - turn)))
+        motor.set_motor(DRIVE_RIGHT, int(DRIVE_SIDE_BCK * (speed + turn)))
+        motor.set_motor(DRIVE_BACK, int(DRIVE_SIDE_FWD * speed))
+        motor.set_motor(DRIVE_FWD, int(DRIVE_SIDE_FWD * speed))
+
+@command
 @state("step_front")
 def lower_front() -> None:
     """Moves the front stepper down, to the base position"""
     motor.set_motor(STEP_FRONT, SPEED)
 
+@command
 @state("step_front")
 def lift_front() -> None:
     """Moves the front stepper upwards, from the base position"""
     motor.set_motor(STEP_FRONT, -SPEED)
 
+@command
 @state("step_front")
 def stop_front() -> None:
     """Stops the front stepper"""
     motor.stop_motor(STEP_FRONT)
 
+@command
 @state("step_back")
 def lower_back() -> None:
     """Moves the back stepper down, from the base position"""
     motor.set_motor(STEP_BACK, SPEED)
 
+@command
 @state("step_back")
 def lift_back() -> None:
     """Moves the back stepper upwards, to the base position"""
     motor.set_motor(STEP_BACK, -SPEED)
 
+@command
 @state("step_back")
 def stop_back() -> None:
     """Stops the back stepper"""
     motor.stop_motor(STEP_BACK)
 
+@command
+def move_front(speed: float = 1.0) -> None:
+    """Move the front stepper at `speed`, from -1 (lifting at full speed) to 1
+       (lowering). Like `drive`, this is sent every time, so can be used for
+       continuous control.
+    """
+    STATES["step_front"] = "move_front"
+    motor.set_motor(STEP_FRONT, int(SPEED * max(-1.0, min(1.0, speed))))
+
+@command
+def move_back(speed: float = 1.0) -> None:
+    """Move the back stepper at `speed`, from -1 (lifting at full speed) to 1
+       (lowering). See `move_front`.
+    """
+    STATES["step_back"] = "move_back"
+    motor.set_motor(STEP_BACK, int(SPEED * max(-1.0, min(1.0, speed))))
+
+@command
 def lower_both() -> None:
     """Lower both the front and back motors."""
-    lower_back()
-    lower_front()
+    with motor.MotorFrame():
+        lower_back()
+        lower_front()
 
+@command
 def lift_both() -> None:
     """Lift both the front and back motors."""
-    lift_back()
-    lift_front()
+    with motor.MotorFrame():
+        lift_back()
+        lift_front()
 
 def at_top_of_stairs(data: SensorData) -> bool:
     """ Check to see if the robot is at the top of the stairs """
-    return ((data.front_dist_0.value > 20 or not data.front_dist_0.valid) and
-            (data.front_dist_1.value > 20 or not data.front_dist_1.valid))
+    snapshot = data.snapshot()
+    return ((snapshot.front_dist_0 > 20 or not snapshot.valid("front_dist_0")) and
+            (snapshot.front_dist_1 > 20 or not snapshot.valid("front_dist_1")))
 
 def climb_(data: SensorData, callback: ProgressCallback) -> Callable[[], Coroutine[Any, Any, None]]:
     """Returns a worker which will climb upstairs."""
 
     def obstacle_infront() -> bool:
         """ Detects if there is an obstacle in front of the robot """
-        if not data.front_dist_1.valid and not data.front_dist_0.valid:
+        snapshot = data.snapshot()
+        dist_0, dist_1 = snapshot.front_dist_0, snapshot.front_dist_1
+        if not snapshot.valid("front_dist_1") and not snapshot.valid("front_dist_0"):
             return False
-        if (abs(data.front_dist_0.value - data.front_dist_1.value) > 5
-                and min(data.front_dist_0.value, data.front_dist_1.value) <= 20):
-            LOG.info("Obstacle in front of Spencer, dist_0 = %f, dist_1=%f",
-                     data.front_dist_0.value, data.front_dist_1.value)
+        if abs(dist_0 - dist_1) > 5 and min(dist_0, dist_1) <= 20:
+            LOG.info("Obstacle in front of Spencer, dist_0 = %f, dist_1=%f", dist_0, dist_1)
             return True
         return False
 
     from climb import ClimbController
+    from lift import BACK, FRONT, move_to, move_together
     async def run() -> None:
         step_count = 0
         if at_top_of_stairs(data):
@@ -189,20 +356,11 @@ def climb_(data: SensorData, callback: ProgressCallback) -> Callable[[], Corouti
             step_count += 1
             LOG.info("Climbing step %d", step_count)
             callback("Climbing step %d (finding stair)" % step_count)
+            instrument.phase("finding stair")
 
-            lift_both()
-            while data.get_moving():
-                front, back = False, False
-                if data.front_lifting_rot.get() <= -100:
-                    stop_front()
-                    front = True
-
-                if data.back_lifting_rot.get() <= -30:
-                    stop_back()
-                    back = True
-                if front and back:
-                    break
-                await asyncio.sleep(SLEEP)
+            # Lift both mechanisms off the ground, unless they already are.
+            await asyncio.gather(move_to(data, FRONT, min(data.front_lifting_rot.get(), -100)),
+                                 move_to(data, BACK, min(data.back_lifting_rot.get(), -30)))
 
             # We should return from find wall aligned to the step and as close
             # as we can get before the distance sensors can't read anymore
@@ -210,12 +368,8 @@ def climb_(data: SensorData, callback: ProgressCallback) -> Callable[[], Corouti
 
             # Lift the front mechanism to its upper point
             callback("Climbing step %d (lifting front)" % step_count)
-            while data.get_moving():
-                lift_front()
-                if data.front_lifting_rot.get() <= STEP_FRONT_MIN:
-                    stop()
-                    break
-                await asyncio.sleep(SLEEP)
+            instrument.phase("lifting front")
+            await move_to(data, FRONT, STEP_FRONT_MIN)
 
             while data.get_moving():
                 forward()
@@ -227,83 +381,46 @@ def climb_(data: SensorData, callback: ProgressCallback) -> Callable[[], Corouti
                 if data.middle_stair_touch.get():
                     stop()
                     break
-                await asyncio.sleep(SLEEP)
+                await wait_any((data.middle_stair_touch, data.front_dist_0, data.front_dist_1), SLEEP)
 
             # Lower the front mechanism until touching the stair.
             callback("Climbing step %d (touching off front)" % step_count)
-            while data.get_moving():
-                lower_front()
-                if data.front_ground_touch.get() or data.front_lifting_rot.get() >= STEP_FRONT_MAX:
-                    stop()
-                    break
-                await asyncio.sleep(SLEEP)
+            instrument.phase("touching off front")
+            await move_to(data, FRONT, STEP_FRONT_MAX, until=data.front_ground_touch.get,
+                          watch=(data.front_ground_touch,))
 
             callback("Climbing step %d (climbing)" % step_count)
+            instrument.phase("climbing")
 
-            # HACK HACK HACK: Ensure the back has a head-start on the front, as it
-            #  lifts a little slower.
-            if data.get_moving():
-                lower_back()
-                await asyncio.sleep(0.5)
-                stop()
-
-            target_back = -data.front_lifting_rot.get() + 50
+            # Lower both mechanisms together, lifting the body up onto the step.
+            target_back = min(-data.front_lifting_rot.get() + 50, STEP_BACK_MAX)
             LOG.info("Targeting back lifting of %d", target_back)
-            init = False
+            await move_together(data, ((FRONT, 0), (BACK, target_back)))
+
+            # Then drive forward until the middle is on the step.
             while data.get_moving():
-                if not init:
-                    lower_both()
-                    init = True
-                # If the back one has reached the stair, then we're all good
                 # TODO(anyone): Add distance sensor for back stair
                 # was using data.back_stair_touch.get()
-                # if data.middle_ground_touch.get():
-                #     LOG.info("Back stair touch hit, finishing climb")
-                #     stop()
-                #     break
-
-                if data.front_lifting_rot.get() >= 0:
-                    if data.middle_ground_touch.get():
-                        LOG.info("Back stair touch hit, finishing climb")
-                        stop()
-                        break
-                    stop_front()
-                else:
-                    lower_front()
-
-                # TODO(anyone): Reach max extension / max back rotation start going forward
-                if data.back_lifting_rot.get() >= target_back or data.back_lifting_rot.get() >= STEP_BACK_MAX:
-                    stop_back()
-                    forward()
-                    # Detect if obstacle is in front and stop
-                    if obstacle_infront():
-                        stop_forward()
-                        await asyncio.sleep(0.25)
-
-                    if data.middle_ground_touch.get():
-                        LOG.info("Back stair touch hit, finishing climb")
-                        stop()
-                        break
-                else:
-                    lower_back()
+                if data.middle_ground_touch.get():
+                    LOG.info("Back stair touch hit, finishing climb")
+                    stop()
+                    break
 
+                forward()
+                # Detect if obstacle is in front and stop
+                if obstacle_infront():
+                    stop_forward()
+                    await asyncio.sleep(0.25)
+                await wait_any((data.middle_ground_touch, data.front_dist_0, data.front_dist_1), SLEEP)
 
             callback("Climbing step %d (lifting back)" % step_count)
-            while data.get_moving():
-                lift_back()
-                if data.back_lifting_rot.get() <= STEP_BACK_MIN:
-                    stop()
-                    break
-                await asyncio.sleep(SLEEP)
+            instrument.phase("lifting back")
+            await move_to(data, BACK, STEP_BACK_MIN)
 
             await asyncio.sleep(SLEEP)
 
-        while data.get_moving():
-            lift_back()
-            if data.back_lifting_rot.get() <= STEP_BACK_MIN:
-                stop()
-                break
-            await asyncio.sleep(SLEEP)
+        instrument.phase("finishing")
+        await move_to(data, BACK, min(data.back_lifting_rot.get(), STEP_BACK_MIN))
 
         forward()
         await asyncio.sleep(1)
@@ -316,13 +433,16 @@ def climb_(data: SensorData, callback: ProgressCallback) -> Callable[[], Corouti
 def downstairs_(data: SensorData, callback: ProgressCallback) -> Callable[[], Coroutine[Any, Any, None]]:
     """Returns a worker which will climb downstairs"""
     from climb import ClimbController
+    from lift import BACK, FRONT, Coordinator, move_to
     async def run() -> None:
+        loop = asyncio.get_event_loop()
         is_at_bottom_of_stairs = False
         step_count = 0
         while not is_at_bottom_of_stairs and data.get_moving():
             step_count += 1
             LOG.info("Descending step %d", step_count)
             callback("Descending step %d (finding stair)" % step_count)
+            instrument.phase("finding stair")
 
             # Backwards until back ground is not touching and we have a reading
             # on the distance sensor
@@ -331,50 +451,42 @@ def downstairs_(data: SensorData, callback: ProgressCallback) -> Callable[[], Co
                 if not data.back_ground_touch.get() and not data.middle_ground_touch.get():
                     stop()
                     break
-                await asyncio.sleep(SLEEP)
+                await wait_any((data.back_ground_touch, data.middle_ground_touch), SLEEP)
 
-            while data.get_moving:
+            while data.get_moving():
                 lower_front()
                 if data.front_ground_touch.get():
                     stop_front()
                     break
-                await asyncio.sleep(SLEEP)
+                await data.front_ground_touch.wait_for(True, SLEEP)
 
             # Try and align with stairs if off
             if step_count != 1:
                 await ClimbController(data).downstairs_find_wall()
 
             callback("Descending step %d (lowering back)" % step_count)
-            while data.get_moving:
-                lower_back()
-                if data.back_ground_touch.get() or data.back_lifting_rot.get() >= STEP_BACK_MAX:
-                    stop_back()
-                    break
-                await asyncio.sleep(SLEEP)
-
-            while data.get_moving():
-                backward() # Backward until back stair distance sensor reaches our set limit
-                # TODO: We need to make sure this is correct. Made it lower than it was.
-                if data.front_ground_dist.valid and data.front_ground_dist.get() > 9:
-                    # HACK: There's probably better solutions, but it's the day before the demo and
-                    # the only thing stopping me killing Spencer is lack of a credible alibi.
-                    await asyncio.sleep(0.7)
-                    stop()
-                    break
-                await asyncio.sleep(SLEEP)
-
-            # HACK HACK HACK: Ensure the front has a head-start on the back, as it
-            #  moves a little slower.
-            if data.get_moving():
-                lift_front()
-                await asyncio.sleep(0.5)
-                stop()
+            instrument.phase("lowering back")
+            await move_to(data, BACK, STEP_BACK_MAX, until=data.back_ground_touch.get,
+                          watch=(data.back_ground_touch,))
+
+            with data.data_intervals(EDGE_INTERVALS):
+                while data.get_moving():
+                    backward() # Backward until back stair distance sensor reaches our set limit
+                    # TODO: We need to make sure this is correct. Made it lower than it was.
+                    if data.front_ground_dist.valid and data.front_ground_dist.get() > 9:
+                        # HACK: There's probably better solutions, but it's the day before the demo and
+                        # the only thing stopping me killing Spencer is lack of a credible alibi.
+                        await asyncio.sleep(0.7)
+                        stop()
+                        break
+                    await wait_any((data.front_ground_dist,), SLEEP)
 
-            # Lift both until middle is on the ground
+            # Lift both together until middle is on the ground, so the front
+            # reaches max extension as the back reaches normal.
             callback("Descending step %d (lowering)" % step_count)
+            instrument.phase("lowering")
+            coordinator = Coordinator(data, ((FRONT, STEP_FRONT_MIN), (BACK, STEP_BACK_MIN + 100)))
             while data.get_moving():
-                lift_both()
-
                 if data.middle_ground_touch.get():
                     # The robot is at an angle when it lower's downstairs, I added a wait to make it less so
                     await asyncio.sleep(0.35)
@@ -382,55 +494,51 @@ def downstairs_(data: SensorData, callback: ProgressCallback) -> Callable[[], Co
                     break
 
                 # Check if middle is touching,
-                if data.back_lifting_rot.get() <= STEP_BACK_MIN + 100:
+                if coordinator.update():
                     stop()
-                    LOG.error("Cannot go downstairs. Back is at normal" \
-                              "and middle is not touching step. rot = %f", \
-                              data.back_lifting_rot.get())
-                    # data.set_moving(False)
-                    break
-
-                if data.front_lifting_rot.get() <= STEP_FRONT_MIN:
-                    stop()
-                    LOG.error("Cannot go downstairs. Front is at max extension "
-                              "and middle is not touching step. rot = %f",
-                              data.front_lifting_rot.get())
+                    LOG.error("Cannot go downstairs. Front is at max extension, back is at normal "
+                              "and middle is not touching step. front = %f, back = %f",
+                              data.front_lifting_rot.get(), data.back_lifting_rot.get())
                     data.set_moving(False)
                     break
 
-                await asyncio.sleep(SLEEP)
+                await wait_any((data.middle_ground_touch, data.front_lifting_rot, data.back_lifting_rot), SLEEP)
 
             # Move back so you can fit front on step
-            start_time = time.time()
+            start_time = loop.time()
             callback("Descending step %d (finishing off)" % step_count)
+            instrument.phase("finishing off")
             while data.get_moving():
                 backward()
                 # To determine if Spencer is at the bottom of the stairs
-                if time.time() - start_time > 3:
+                if loop.time() - start_time > 3:
                     is_at_bottom_of_stairs = True
                     data.set_moving(False)
                     stop()
                     break
-                LOG.debug("Backwards %ds", time.time() - start_time)
+                LOG.debug("Backwards %ds", loop.time() - start_time)
                 if not data.back_ground_touch.get() and not data.middle_ground_touch.get():
                     await asyncio.sleep(0.15) # HACK
                     stop()
                     break
-                await asyncio.sleep(SLEEP)
+                await wait_any((data.back_ground_touch, data.middle_ground_touch), SLEEP)
         await zero(data, callback)
         await asyncio.sleep(SLEEP)
         callback("Idle")
 
     return run
 
-def climb(data: SensorData, callback: ProgressCallback) -> None:
+@command
+async def climb(data: SensorData, callback: ProgressCallback) -> None:
     """Tries to climb upstairs automatically"""
-    asyncio.get_event_loop().create_task(climb_(data, callback)())
+    await climb_(data, callback)()
 
-def downstairs(data: SensorData, callback: ProgressCallback) -> None:
+@command
+async def downstairs(data: SensorData, callback: ProgressCallback) -> None:
     """Tries to climb downstairs automatically"""
-    asyncio.get_event_loop().create_task(downstairs_(data, callback)())
+    await downstairs_(data, callback)()
 
+@command
 async def zero(data: SensorData, callback: ProgressCallback) -> None:
     """Zeros out the rotation sensors. We attempt to move the front and back
        lifting mechanisms to the bottom position, and then reset them to
@@ -438,17 +546,16 @@ async def zero(data: SensorData, callback: ProgressCallback) -> None:
 
     """
     callback("Resetting motors")
+    instrument.phase("zeroing")
 
     if not data.front_ground_touch.get():
         lower_front()
-        while not data.front_ground_touch.get():
-            await asyncio.sleep(SLEEP)
+        await data.front_ground_touch.wait_for(True)
         stop()
 
     if not data.back_ground_touch.get():
         lower_back()
-        while not data.back_ground_touch.get():
-            await asyncio.sleep(SLEEP)
+        await data.back_ground_touch.wait_for(True)
         stop()
 
     data.front_lifting_rot.reset()
@@ -457,30 +564,27 @@ async def zero(data: SensorData, callback: ProgressCallback) -> None:
 
     callback("Idle")
 
-def timed(data: SensorData, callback: ProgressCallback) -> None:
+@command
+async def timed(data: SensorData, callback: ProgressCallback) -> None:
     """Goes upstairs and downstairs, then prints out the times"""
-    async def run() -> None:
-        start = time.time()
-        await climb_(data, callback)()
-        LOG.info("upstairs %f", time.time() - start)
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    await climb_(data, callback)()
+    LOG.info("upstairs %f", loop.time() - start)
 
-        await asyncio.sleep(3)
+    await asyncio.sleep(3)
 
-        start = time.time()
-        await downstairs_(data, callback)()
-        LOG.info("down %f", time.time() - start)
+    start = loop.time()
+    await downstairs_(data, callback)()
+    LOG.info("down %f", loop.time() - start)
 
-    asyncio.get_event_loop().create_task(run())
-
-def hello(data: SensorData) -> None:
+@command
+async def hello(data: SensorData) -> None:
     """Makes Spencer say hello!"""
-    async def run() -> None:
+    turn_left()
+    await asyncio.sleep(1.0)
+    while data.get_moving():
+        turn_right()
+        await asyncio.sleep(2.0)
         turn_left()
-        await asyncio.sleep(1.0)
-        while data.get_moving():
-            turn_right()
-            await asyncio.sleep(2.0)
-            turn_left()
-            await asyncio.sleep(2.0)
-
-    asyncio.get_event_loop().create_task(run())
+        await asyncio.sleep(2.0)
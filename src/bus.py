@@ -0,0 +1,374 @@
+"""Shared access to the I2C bus, which the motor board and encoders sit on.
+
+   Every transaction goes through a single `Bus`, which serialises access from
+   the event loop and the encoder thread. The backend it talks to is only
+   created when first used, so importing this (or `motor`) never touches the
+   hardware. Use `use` to swap in another backend, such as `SimulatedBackend`
+   when running away from the robot.
+
+   Once `start` is called, transactions are instead carried out by a
+   `Scheduler` thread which owns the bus, so writes never block the caller.
+   Until then (as in the simulator) they happen immediately on the calling
+   thread.
+"""
+
+from concurrent.futures import Future
+import heapq
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from instrument import Histogram
+
+LOG = logging.getLogger("Bus")
+
+# The I2C bus the boards are on, and their addresses.
+BUS_NUMBER = 1
+MOTOR_ADDRESS = 0x04
+ENCODER_ADDRESS = 0x05
+
+class Backend:
+    """Something which can carry out I2C transactions."""
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        """Write several blocks of bytes to a device, in one combined transaction."""
+        raise NotImplementedError()
+
+    def read(self, address: int, length: int) -> List[int]:
+        """Read some bytes from a device."""
+        raise NotImplementedError()
+
+    def write_byte(self, address: int, value: int) -> None:
+        """Write a single byte to a device."""
+        self.write(address, [[value]])
+
+    def close(self) -> None:
+        """Release the bus."""
+
+class SMBusBackend(Backend):
+    """The real I2C bus, using smbus2."""
+
+    def __init__(self, number: int = BUS_NUMBER) -> None:
+        import smbus2 # pylint: disable=import-outside-toplevel
+        self.msg = smbus2.i2c_msg
+        self.bus = smbus2.SMBus(number)
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        self.bus.i2c_rdwr(*[self.msg.write(address, list(block)) for block in blocks])
+
+    def read(self, address: int, length: int) -> List[int]:
+        msg = self.msg.read(address, length)
+        self.bus.i2c_rdwr(msg)
+        return list(msg) # type: ignore
+
+    def write_byte(self, address: int, value: int) -> None:
+        self.bus.write_byte(address, value)
+
+    def close(self) -> None:
+        self.bus.close()
+
+class SimulatedBackend(Backend):
+    """An in-memory motor board and encoder board.
+
+       The motor board holds the speed of each motor, and the encoders count
+       `lift_rate` ticks a second for each lifting motor at full speed. This is
+       enough for the server to run without hardware. See `sim` for a full
+       simulation of the robot.
+    """
+
+    def __init__(self, front: int = 2, back: int = 3, lift_rate: float = 1000.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.front = front
+        self.back = back
+        self.lift_rate = lift_rate
+        self.clock = clock
+
+        self.speeds = [0] * 8
+        self.last_read = clock()
+        # Encoder ticks not yet reported, as the board only sends a byte each.
+        self.front_unread = 0.0
+        self.back_unread = 0.0
+
+    def _command(self, data: Sequence[int]) -> None:
+        if data[0] & 1:
+            # Float all motors
+            self.speeds = [0] * len(self.speeds)
+            return
+
+        motor_id, mode = data[0] >> 5, (data[0] >> 1) & 3
+        speed = data[1] if len(data) > 1 else 0
+        self.speeds[motor_id] = speed if mode == 2 else -speed if mode == 3 else 0
+
+    def _advance(self) -> None:
+        now = self.clock()
+        elapsed, self.last_read = now - self.last_read, now
+        self.front_unread += self.speeds[self.front] / 255 * self.lift_rate * elapsed
+        self.back_unread += self.speeds[self.back] / 255 * self.lift_rate * elapsed
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        if address != MOTOR_ADDRESS:
+            raise IOError("No device at address %d" % address)
+
+        self._advance()
+        for block in blocks:
+            self._command(block)
+
+    def read(self, address: int, length: int) -> List[int]:
+        if address != ENCODER_ADDRESS:
+            raise IOError("No device at address %d" % address)
+
+        self._advance()
+        back = max(-128, min(127, int(self.back_unread)))
+        front = max(-128, min(127, int(self.front_unread)))
+        self.back_unread -= back
+        self.front_unread -= front
+        return [back & 0xFF, front & 0xFF][:length]
+
+class Bus:
+    """A backend shared between threads, which is created on first use."""
+
+    def __init__(self, factory: Callable[[], Backend] = SMBusBackend) -> None:
+        self.factory = factory
+        self.lock = threading.RLock()
+        self._backend = None # type: Optional[Backend]
+        self.transactions = 0
+
+    @property
+    def backend(self) -> Backend:
+        """The backend, creating it if needed."""
+        with self.lock:
+            if self._backend is None:
+                self._backend = self.factory()
+            return self._backend
+
+    def use(self, backend: Optional[Backend]) -> Optional[Backend]:
+        """Replace the backend, returning the previous one (if it was created).
+           Passing None means the default backend is created on next use.
+        """
+        with self.lock:
+            previous, self._backend = self._backend, backend
+            return previous
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        """See `Backend.write`."""
+        with self.lock:
+            self.backend.write(address, blocks)
+            self.transactions += 1
+
+    def read(self, address: int, length: int) -> List[int]:
+        """See `Backend.read`."""
+        with self.lock:
+            result = self.backend.read(address, length)
+            self.transactions += 1
+            return result
+
+    def write_byte(self, address: int, value: int) -> None:
+        """See `Backend.write_byte`."""
+        with self.lock:
+            self.backend.write_byte(address, value)
+            self.transactions += 1
+
+    def close(self) -> None:
+        """Close the backend, if it was created."""
+        with self.lock:
+            if self._backend is not None:
+                self._backend.close()
+                self._backend = None
+
+# Transaction priorities, most urgent first.
+ESTOP = 0
+MOTOR = 1
+ENCODER = 2
+PRIORITY_NAMES = ("estop", "motor", "encoder")
+
+# The most motor writes merged into a single transaction.
+MAX_BATCH = 16
+
+# Upper bounds (in seconds) of the transaction latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, float("inf"))
+
+class Request:
+    """A transaction waiting for the scheduler."""
+    __slots__ = ("priority", "kind", "address", "payload", "future", "submitted", "generation")
+
+    def __init__(self, priority: int, kind: str, address: int, payload: Any, generation: int) -> None:
+        self.priority = priority
+        self.kind = kind
+        self.address = address
+        self.payload = payload
+        self.future = Future() # type: Future[Any]
+        self.submitted = time.monotonic()
+        self.generation = generation
+
+class Scheduler(threading.Thread):
+    """Owns the bus, carrying out transactions in order of priority.
+
+       Adjacent motor writes to the same device are merged into one
+       transaction. An emergency stop also discards every motor write queued
+       before it, so nothing can restart the motors once they are stopped.
+    """
+
+    def __init__(self, bus: Bus) -> None:
+        super().__init__(name="Bus", daemon=True)
+        self.bus = bus
+        self.condition = threading.Condition()
+        self.queue = [] # type: List[Any]
+        self.sequence = 0
+        self.generation = 0
+        self.stopped = False
+
+        # Per-priority time from submission to completion.
+        self.latency = [Histogram(LATENCY_BUCKETS) for _ in PRIORITY_NAMES]
+        self.transactions = 0
+        self.batched = 0
+        self.discarded = 0
+
+    def submit(self, priority: int, kind: str, address: int, payload: Any) -> "Future[Any]":
+        """Queue a transaction, returning a future for its result."""
+        with self.condition:
+            if priority == ESTOP:
+                self.generation += 1
+            request = Request(priority, kind, address, payload, self.generation)
+            if self.stopped:
+                request.future.cancel()
+                return request.future
+
+            self.sequence += 1
+            heapq.heappush(self.queue, (priority, self.sequence, request))
+            self.condition.notify()
+        return request.future
+
+    def stop(self) -> None:
+        """Stop the scheduler once every queued transaction is done. Any submitted
+           afterwards are cancelled.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def _next(self) -> Optional[List[Request]]:
+        """Wait for the next transaction, along with any it can be merged with."""
+        with self.condition:
+            while not self.queue and not self.stopped:
+                self.condition.wait()
+            if not self.queue:
+                return None
+
+            batch = [heapq.heappop(self.queue)[2]]
+            first = batch[0]
+            if first.kind == "write":
+                while (self.queue and len(batch) < MAX_BATCH and self.queue[0][2].kind == "write" and
+                       self.queue[0][2].priority == first.priority and self.queue[0][2].address == first.address):
+                    batch.append(heapq.heappop(self.queue)[2])
+
+            if first.priority != ESTOP:
+                # Drop any motor writes which an emergency stop has superseded.
+                live = [request for request in batch
+                        if request.priority != MOTOR or request.generation == self.generation]
+                for request in batch:
+                    if request not in live:
+                        request.future.cancel()
+                        self.discarded += 1
+                batch = live
+            return batch
+
+    def _execute(self, batch: List[Request]) -> None:
+        first = batch[0]
+        try:
+            if first.kind == "write":
+                blocks = [block for request in batch for block in request.payload]
+                self.bus.write(first.address, blocks)
+                result = None # type: Any
+            elif first.kind == "byte":
+                result = self.bus.write_byte(first.address, first.payload)
+            else:
+                result = self.bus.read(first.address, first.payload)
+        except Exception as error: # pylint: disable=broad-except
+            LOG.error("%s transaction to %d failed: %s", PRIORITY_NAMES[first.priority], first.address, error)
+            for request in batch:
+                request.future.set_exception(error)
+            return
+
+        now = time.monotonic()
+        self.transactions += 1
+        self.batched += len(batch) - 1
+        for request in batch:
+            self.latency[request.priority].add(now - request.submitted)
+            request.future.set_result(result)
+
+    def run(self) -> None:
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            if batch:
+                self._execute(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics on the transactions carried out."""
+        return {
+            "transactions": self.transactions,
+            "batched": self.batched,
+            "discarded": self.discarded,
+            "latency": {name: self.latency[i].stats() for i, name in enumerate(PRIORITY_NAMES)},
+        }
+
+BUS = Bus()
+SCHEDULER = None # type: Optional[Scheduler]
+
+def start() -> Scheduler:
+    """Start a scheduler thread to own the shared bus."""
+    global SCHEDULER # pylint: disable=global-statement
+    if SCHEDULER is None:
+        SCHEDULER = Scheduler(BUS)
+        SCHEDULER.start()
+    return SCHEDULER
+
+def stop() -> None:
+    """Stop the scheduler, so transactions happen on the calling thread again."""
+    global SCHEDULER # pylint: disable=global-statement
+    scheduler, SCHEDULER = SCHEDULER, None
+    if scheduler is not None:
+        scheduler.stop()
+        scheduler.join()
+
+def _done(result: Any = None) -> "Future[Any]":
+    future = Future() # type: Future[Any]
+    future.set_result(result)
+    return future
+
+def use(backend: Optional[Backend]) -> Optional[Backend]:
+    """Replace the shared bus's backend. See `Bus.use`."""
+    return BUS.use(backend)
+
+def write(address: int, blocks: Sequence[Sequence[int]], priority: int = MOTOR) -> "Future[None]":
+    """Write to a device on the shared bus. See `Backend.write`.
+
+       This returns as soon as the write is queued. The returned future can be
+       awaited with `asyncio.wrap_future`.
+    """
+    if SCHEDULER is not None:
+        return SCHEDULER.submit(priority, "write", address, [list(block) for block in blocks])
+    BUS.write(address, blocks)
+    return _done()
+
+def write_byte(address: int, value: int, priority: int = MOTOR) -> "Future[None]":
+    """Write a byte to a device on the shared bus. See `Backend.write_byte`."""
+    if SCHEDULER is not None:
+        return SCHEDULER.submit(priority, "byte", address, value)
+    BUS.write_byte(address, value)
+    return _done()
+
+def read(address: int, length: int, priority: int = ENCODER) -> List[int]:
+    """Read from a device on the shared bus, waiting for the result. See
+       `Backend.read`.
+    """
+    if SCHEDULER is not None:
+        return SCHEDULER.submit(priority, "read", address, length).result() # type: ignore
+    return BUS.read(address, length)
+
+def close() -> None:
+    """Stop the scheduler and close the shared bus. See `Bus.close`."""
+    stop()
+    BUS.close()
@@ -4,15 +4,105 @@
 
 import asyncio
 import logging
+import math
+from typing import Optional, Tuple
 
-from data import SensorData
+from data import ALIGNING_INTERVALS, SensorData
+from pid import Gains, PID
+from sensor import wait_any
 import autonomous_control as control
+import instrument
 
 LOG = logging.getLogger("climb")
 
 # The time to sleep between each computation step
 SLEEP = 0.05
 
+# We align against a wall with two controllers: one turns us to face the wall
+# square on (driving the difference between the front sensors to zero), and one
+# drives us towards it. Their errors are in cm, and outputs are speeds from -1
+# to 1 (see `autonomous_control.drive`).
+TURN_GAINS = Gains(kp=0.12, ki=0.05, kd=0.0, integral_limit=4.0)
+DRIVE_GAINS = Gains(kp=0.5, ki=0.0, kd=0.0, integral_limit=0.0)
+
+# Where we drive to, and how close we must be to stop.
+TARGET_DISTANCE = 5.0
+STOP_DISTANCE = 6.0
+
+# We are aligned once the front sensors agree to within ALIGNED_DELTA cm, and
+# are within STOP_DISTANCE, for ALIGNED_READINGS readings in a row. We keep
+# turning towards square until within TURN_DEADBAND cm though, so we don't
+# settle at the edge of being aligned.
+ALIGNED_DELTA = 0.75
+ALIGNED_READINGS = 1
+TURN_DEADBAND = 0.25
+
+# The slowest the motors can turn or drive us, and how misaligned (in cm) we
+# can be before we stop driving forward and only turn.
+MIN_TURN = 0.3
+MIN_SPEED = 0.25
+SLOW_DELTA = 5.0
+
+# Speeds are rounded to this, and only changed once they move by more than it,
+# so noisy readings don't each send a motor command.
+SPEED_STEP = 0.1
+
+# The time constant (in seconds) we smooth the difference between the front
+# sensors over. Their noise adds together, which would otherwise flip the
+# direction we turn on every reading.
+DELTA_SMOOTHING = 0.03
+
+def _settle(value: float, previous: float) -> float:
+    if value != 0 and abs(value - previous) <= SPEED_STEP:
+        return previous
+    return round(value / SPEED_STEP) * SPEED_STEP
+
+class Aligner:
+    """Works out how to drive and turn to line up square on to a wall, from
+       the distance to it and the difference between the two front sensors.
+       If `advance` is False, we only turn on the spot.
+    """
+
+    def __init__(self, advance: bool = True) -> None:
+        self.advance = advance
+        self.turn = PID(TURN_GAINS, limit=1.0)
+        self.drive = PID(DRIVE_GAINS, limit=1.0)
+        self.aligned = 0
+        self.output = (0.0, 0.0)
+        self.delta = None # type: Optional[float]
+        self.last_time = 0.0
+
+    @property
+    def converged(self) -> bool:
+        """Whether we have been aligned for long enough to stop."""
+        return self.aligned >= ALIGNED_READINGS
+
+    def update(self, distance: float, delta: float, now: float) -> Tuple[float, float]:
+        """Get the speed and turn for a reading at time `now`."""
+        if self.delta is None:
+            self.delta = delta
+        else:
+            self.delta += (1 - math.exp(-(now - self.last_time) / DELTA_SMOOTHING)) * (delta - self.delta)
+        self.last_time = now
+        delta = self.delta
+
+        turn = self.turn.update(delta, now)
+        speed = max(0.0, self.drive.update(distance - TARGET_DISTANCE, now))
+
+        close = not self.advance or distance <= STOP_DISTANCE
+        self.aligned = self.aligned + 1 if close and abs(delta) <= ALIGNED_DELTA else 0
+        if abs(delta) <= TURN_DEADBAND:
+            turn = 0.0
+        else:
+            turn = max(MIN_TURN, abs(turn)) * (1 if delta > 0 else -1)
+
+        if close:
+            speed = 0.0
+        else:
+            speed = max(MIN_SPEED, speed * max(0.0, 1 - abs(delta) / SLOW_DELTA))
+        self.output = _settle(speed, self.output[0]), _settle(turn, self.output[1])
+        return self.output
+
 class ClimbController:
     """The main controller for Spencer, reading from sensor input and
        executing work on the motors."""
@@ -27,45 +117,50 @@ class ClimbController:
            we're within 5 blocks of a wall, or False otherwise."""
         left, right = self.sensors.front_dist_1, self.sensors.front_dist_0
         failure = 0
+        loop = asyncio.get_event_loop()
+        aligner = Aligner()
         LOG.info("Attempting to align against a wall. This is gonna go badly.")
-        while self.sensors.get_moving():
-            if failure > 10:
-                LOG.error("front_up aborting due to too many failed reads")
-                return False
-
-            # If only one is valid, rotate towards the valid sensor
-            if left.valid and left.value >= 10 and not right.valid:
-                control.turn_left()
-            elif right.valid and right.value >= 10 and not left.valid:
-                control.turn_right()
-
-            # If neither are valid, then drive forward.
-            elif not left.valid or not right.valid:
-                control.forward()
-            else:
-                failure = 0
-                distance = min(left.value, right.value)
-                delta = left.value - right.value
-                LOG.debug("Distance=%f, delta=%f", distance, delta)
-
-                # If we're a long way away, continue to move forward
-                if distance >= 25:
+        instrument.phase("aligning")
+        with self.sensors.data_intervals(ALIGNING_INTERVALS):
+            while self.sensors.get_moving():
+                # Read both sensors at the same instant, so we don't compare readings
+                # from different times.
+                snapshot = self.sensors.snapshot()
+                left_valid, left_value = snapshot.valid("front_dist_1"), snapshot.front_dist_1
+                right_valid, right_value = snapshot.valid("front_dist_0"), snapshot.front_dist_0
+
+                if failure > 10:
+                    LOG.error("front_up aborting due to too many failed reads")
+                    return False
+
+                # If only one is valid, rotate towards the valid sensor
+                if left_valid and left_value >= 10 and not right_valid:
+                    control.turn_left()
+                elif right_valid and right_value >= 10 and not left_valid:
+                    control.turn_right()
+
+                # If neither are valid, then drive forward.
+                elif not left_valid or not right_valid:
                     control.forward()
+                else:
+                    failure = 0
+                    distance = min(left_value, right_value)
+                    delta = left_value - right_value
+                    LOG.debug("Distance=%f, delta=%f", distance, delta)
 
-                # Attempt to align against the wall
-                elif delta > 0.75:
-                    control.turn_right(0.4 if not (delta > 5) else 1)
-                elif delta < -0.75:
-                    control.turn_left(0.4 if not (delta < -5) else 1)
-                elif distance <= 6:
-                    control.stop()
-                    return True
+                    # If we're a long way away, continue to move forward
+                    if distance >= 25:
+                        control.forward()
 
-                # We're now aligned, but still a way away - move closer!
-                else:
-                    control.forward()
+                    # Otherwise turn to face the wall while moving closer.
+                    else:
+                        speed, turn = aligner.update(distance, delta, loop.time())
+                        if aligner.converged:
+                            control.stop()
+                            return True
+                        control.drive(speed, turn)
 
-            await asyncio.sleep(SLEEP)
+                await wait_any((left, right), SLEEP)
 
         LOG.error("Stopping due to no longer moving.")
         return False
@@ -75,40 +170,46 @@ class ClimbController:
           Returns when we are reasonable aligned to the step in front."""
         left, right = self.sensors.front_dist_1, self.sensors.front_dist_0
         failure = 0
+        loop = asyncio.get_event_loop()
+        aligner = Aligner(advance=False)
         LOG.info("Attempting to align against a wall. This is gonna go badly.")
-        while self.sensors.get_moving():
-            if failure > 3:
-                LOG.error("aborting align wall due to too many failed reads")
-                return True
-
-            # If only one is valid, rotate towards the valid sensor
-            if left.valid and left.value >= 10 and not right.valid:
-                control.turn_left()
-            elif right.valid and right.value >= 10 and not left.valid:
-                control.turn_right()
-
-            # If neither are valid, then we must be too far or too close.
-            elif not left.valid or not right.valid:
-                failure += 1
-            else:
-                failure = 0
-                distance = min(left.value, right.value)
-                delta = left.value - right.value
-                LOG.debug("Distance=%f, delta=%f", distance, delta)
-
-                # If we're a long way away, no point aligning
-                if distance >= 25:
-                    # return True too far away to align
+        instrument.phase("aligning")
+        with self.sensors.data_intervals(ALIGNING_INTERVALS):
+            while self.sensors.get_moving():
+                snapshot = self.sensors.snapshot()
+                left_valid, left_value = snapshot.valid("front_dist_1"), snapshot.front_dist_1
+                right_valid, right_value = snapshot.valid("front_dist_0"), snapshot.front_dist_0
+
+                if failure > 3:
+                    LOG.error("aborting align wall due to too many failed reads")
                     return True
 
-                # Attempt to align against the wall
-                if delta > 0.75:
-                    control.turn_right(0.6 if not (delta > 5) else 1)
-                elif delta < -0.75:
-                    control.turn_left(0.6 if not (delta < -5) else 1)
+                # If only one is valid, rotate towards the valid sensor
+                if left_valid and left_value >= 10 and not right_valid:
+                    control.turn_left()
+                elif right_valid and right_value >= 10 and not left_valid:
+                    control.turn_right()
+
+                # If neither are valid, then we must be too far or too close.
+                elif not left_valid or not right_valid:
+                    failure += 1
                 else:
-                    control.stop()
-                    return True
-            await asyncio.sleep(SLEEP)
+                    failure = 0
+                    distance = min(left_value, right_value)
+                    delta = left_value - right_value
+                    LOG.debug("Distance=%f, delta=%f", distance, delta)
+
+                    # If we're a long way away, no point aligning
+                    if distance >= 25:
+                        # return True too far away to align
+                        return True
+
+                    # Attempt to align against the wall
+                    speed, turn = aligner.update(distance, delta, loop.time())
+                    if aligner.converged:
+                        control.stop()
+                        return True
+                    control.drive(speed, turn)
+                await wait_any((left, right), SLEEP)
         LOG.error("Stopping due to no longer moving.")
         return False
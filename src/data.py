@@ -1,9 +1,93 @@
 """Storage classes for sensor data"""
 
 # pylint: disable=R0902
+from contextlib import contextmanager
 import threading
-
-from sensor import Distance, Touch, FakeSensor, RotaryEncoder
+import time
+from typing import Any, Dict, Iterator, Mapping
+
+from filters import FilterConfig
+from sensor import Distance, Touch, FakeSensor, RotaryEncoder, SensorTable, FASTEST
+
+# The sensors held in a `SensorData`, in the order they are stored in its table.
+SENSORS = (
+    "front_dist_0", "front_dist_1", "front_ground_dist", "back_ground_dist",
+    "front_ground_touch", "middle_stair_touch", "back_stair_touch", "back_ground_touch", "middle_ground_touch",
+    "front_lifting_rot", "back_lifting_rot",
+)
+
+TOUCH_SENSORS = frozenset(name for name in SENSORS if name.endswith("_touch"))
+
+# The sensors which are attached through Phidgets, rather than the I2C bus.
+PHIDGET_SENSORS = tuple(name for name in SENSORS if not name.endswith("_rot"))
+
+# How each distance sensor's readings are filtered (see `filters`). The front
+# sensors steer us while aligning against a wall, where even a median of three
+# lags enough to drive us inside their range, so they only reject spikes.
+DISTANCE_FILTERS = {
+    "front_dist_0": FilterConfig(window=1, alpha=1.0, outlier=4.0, persist=3),
+    "front_dist_1": FilterConfig(window=1, alpha=1.0, outlier=4.0, persist=3),
+    "front_ground_dist": FilterConfig(window=5, alpha=0.5, outlier=4.0, persist=4),
+    "back_ground_dist": FilterConfig(window=5, alpha=0.5, outlier=4.0, persist=4),
+}
+
+# How often (in ms) each distance sensor sends readings, unless a routine asks
+# otherwise with `SensorData.data_intervals`. The ground sensors are only needed
+# at the edge of a step, so are slow when idle.
+DATA_INTERVALS = {
+    "front_dist_0": 50,
+    "front_dist_1": 50,
+    "front_ground_dist": 200,
+    "back_ground_dist": 200,
+}
+
+# Intervals used while aligning against a wall, and while backing up to the
+# edge of a step.
+ALIGNING_INTERVALS = {"front_dist_0": FASTEST, "front_dist_1": FASTEST}
+EDGE_INTERVALS = {"front_ground_dist": 20}
+
+@contextmanager
+def _data_intervals(data: Any, intervals: Mapping[str, int]) -> Iterator[None]:
+    previous = {name: getattr(data, name).set_interval(interval) for name, interval in intervals.items()}
+    try:
+        yield
+    finally:
+        for name, interval in previous.items():
+            getattr(data, name).set_interval(interval)
+
+class SensorSnapshot:
+    """An immutable view of every sensor at a single instant.
+
+       Sensor values are available as attributes (`snapshot.front_dist_0`), with
+       touch sensors being booleans. Whether a reading is valid can be checked
+       with `snapshot.valid("front_dist_0")`.
+    """
+    __slots__ = ("version", "time", "_values", "_valid")
+
+    _INDEX = {name: i for i, name in enumerate(SENSORS)}
+
+    def __init__(self, table: SensorTable) -> None:
+        version, values, valid = table.read()
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "time", time.time())
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_valid", valid)
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            index = SensorSnapshot._INDEX[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        value = self._values[index]
+        return value == 1 if name in TOUCH_SENSORS else value
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("SensorSnapshot is immutable")
+
+    def valid(self, name: str) -> bool:
+        """Whether the given sensor had a valid reading."""
+        return self._valid[SensorSnapshot._INDEX[name]] == 1
 
 class SensorData:
     """Contains the sensor data from the robot."""
@@ -26,10 +110,14 @@ class SensorData:
         # TODO(anyone): Need to check these channels
 
         # Distance sensors
-        self.front_dist_0 = Distance("front_dist_0", 0)
-        self.front_dist_1 = Distance("front_dist_1", 1)
-        self.front_ground_dist = Distance("front_ground_dist", 2)
-        self.back_ground_dist = Distance("back_ground_dist", 3)
+        self.front_dist_0 = Distance("front_dist_0", 0, DISTANCE_FILTERS["front_dist_0"],
+                                     DATA_INTERVALS["front_dist_0"])
+        self.front_dist_1 = Distance("front_dist_1", 1, DISTANCE_FILTERS["front_dist_1"],
+                                     DATA_INTERVALS["front_dist_1"])
+        self.front_ground_dist = Distance("front_ground_dist", 2, DISTANCE_FILTERS["front_ground_dist"],
+                                          DATA_INTERVALS["front_ground_dist"])
+        self.back_ground_dist = Distance("back_ground_dist", 3, DISTANCE_FILTERS["back_ground_dist"],
+                                         DATA_INTERVALS["back_ground_dist"])
 
         # Touch sensors
         self.front_ground_touch = Touch("front_ground_touch", 0)
@@ -41,6 +129,24 @@ class SensorData:
         self.front_lifting_rot = RotaryEncoder("front_lifting_rot")
         self.back_lifting_rot = RotaryEncoder("back_lifting_rot")
 
+        self.table = SensorTable(SENSORS)
+        for slot, name in enumerate(SENSORS):
+            getattr(self, name).bind(self.table, slot)
+
+    def snapshot(self) -> SensorSnapshot:
+        """Get a consistent view of every sensor at this instant."""
+        return SensorSnapshot(self.table)
+
+    def data_intervals(self, intervals: Mapping[str, int]) -> Any:
+        """Change how often (in ms) some sensors send readings, while used with
+           `with`. The previous intervals are restored afterwards.
+        """
+        return _data_intervals(self, intervals)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get how often each Phidget sensor is sending readings."""
+        return {name: getattr(self, name).stats() for name in PHIDGET_SENSORS}
+
     @staticmethod
     def set_moving(value: bool) -> None:
         """ Set is moving value """
@@ -55,23 +161,34 @@ class SensorData:
 
 
 class FakeSensorData:
-    """An mock version of SensorData, containing just fake sensors."""
+    """An mock version of SensorData, containing just fake sensors.
 
-    def __init__(self):
-        # Distance sensors
-        self.front_dist_0 = FakeSensor("front_distance_0")
-        self.front_dist_1 = FakeSensor("front_distance_1")
-        self.back_ground_dist = FakeSensor("back_ground_dist")
-        self.middle_ground_dist = FakeSensor("back_ground_dist")
+       This has the same sensors (and the same methods) as `SensorData`, so can
+       be passed to any of the control routines.
+    """
 
-        # Touch sensors
-        self.back_ground_touch = FakeSensor("back_ground_touch")
-        self.back_lifting_normal = FakeSensor("back_lifting_normal")
-        self.back_lifting_extended_max = FakeSensor("back_lifting_extended_max")
-        self.back_stair_touch = FakeSensor("back_stair_touch")
-        self.front_ground_touch = FakeSensor("front_ground_touch")
-        self.front_stair_touch = FakeSensor("front_stair_touch")
-        self.front_lifting_normal = FakeSensor("front_lifting_normal")
-        self.front_lifting_extended_max = FakeSensor("front_lifting_extended_max")
-        self.front_middle_stair_touch = FakeSensor("front_middle_stair_touch")
-        self.middle_ground_touch = FakeSensor("middle_ground_touch")
+    def __init__(self) -> None:
+        for name in SENSORS:
+            setattr(self, name, FakeSensor(name))
+
+        self.table = SensorTable(SENSORS)
+        for slot, name in enumerate(SENSORS):
+            getattr(self, name).bind(self.table, slot)
+
+        self.is_moving = False
+
+    def snapshot(self) -> SensorSnapshot:
+        """Get a consistent view of every sensor at this instant."""
+        return SensorSnapshot(self.table)
+
+    def data_intervals(self, intervals: Mapping[str, int]) -> Any:
+        """See `SensorData.data_intervals`."""
+        return _data_intervals(self, intervals)
+
+    def set_moving(self, value: bool) -> None:
+        """ Set is moving value """
+        self.is_moving = value
+
+    def get_moving(self) -> bool:
+        """ get is moving """
+        return self.is_moving
@@ -0,0 +1,105 @@
+"""
+Compares the PID wall alignment in `climb` with the old bang-bang one, by
+climbing a batch of simulated staircases with each.
+
+For each controller we report how many staircases were climbed, how long
+aligning took (and how much that varied), how many motor commands it sent, and
+how far from square on (in degrees) we were left facing the wall.
+
+Usage: python demos/align_bench.py [count] [noise...] (from the src directory)
+"""
+
+import logging
+import math
+import random
+import statistics
+import sys
+from typing import List, Type
+
+sys.path.insert(0, ".")
+
+# pylint: disable=wrong-import-position
+import sim
+sim.install(sim.Plant())
+
+from data import ALIGNING_INTERVALS
+from sensor import wait_any
+import autonomous_control as control
+import climb
+import instrument
+
+class LegacyClimbController(climb.ClimbController):
+    """The controller with the alignment `find_wall` used to use: turning at a
+       fixed speed while misaligned, and otherwise driving forward.
+    """
+
+    async def find_wall(self) -> bool:
+        left, right = self.sensors.front_dist_1, self.sensors.front_dist_0
+        instrument.phase("aligning")
+        with self.sensors.data_intervals(ALIGNING_INTERVALS):
+            while self.sensors.get_moving():
+                snapshot = self.sensors.snapshot()
+                left_valid, left_value = snapshot.valid("front_dist_1"), snapshot.front_dist_1
+                right_valid, right_value = snapshot.valid("front_dist_0"), snapshot.front_dist_0
+
+                if left_valid and left_value >= 10 and not right_valid:
+                    control.turn_left()
+                elif right_valid and right_value >= 10 and not left_valid:
+                    control.turn_right()
+                elif not left_valid or not right_valid:
+                    control.forward()
+                else:
+                    distance = min(left_value, right_value)
+                    delta = left_value - right_value
+                    if distance >= 25:
+                        control.forward()
+                    elif delta > 0.75:
+                        control.turn_right(0.4 if not (delta > 5) else 1)
+                    elif delta < -0.75:
+                        control.turn_left(0.4 if not (delta < -5) else 1)
+                    elif distance <= 6:
+                        control.stop()
+                        return True
+                    else:
+                        control.forward()
+
+                await wait_any((left, right), climb.SLEEP)
+        return False
+
+def bench(name: str, controller: Type[climb.ClimbController], count: int, noise: float) -> None:
+    """Climb `count` random staircases using the given controller."""
+    headings = [] # type: List[float]
+    find_wall = controller.find_wall
+
+    async def measured(self: climb.ClimbController) -> bool:
+        result = await find_wall(self)
+        headings.append(abs(math.degrees(sim.PLANT.heading)))
+        return result
+
+    original = climb.ClimbController
+    climb.ClimbController = type(controller.__name__, (controller,), {"find_wall": measured})
+    try:
+        rng = random.Random(0)
+        results = [sim.simulate(sim.random_staircase(rng), noise=noise, timeout=120) for _ in range(count)]
+    finally:
+        climb.ClimbController = original
+
+    climbed = sum(1 for result in results if result.finished and result.steps_climbed == result.stairs.steps)
+    steps = [result.timings["phases"].get("aligning") for result in results]
+    times = [phase["duration"] / phase["entered"] for phase in steps if phase]
+    commands = [phase["commands"] / phase["entered"] for phase in steps if phase]
+
+    print("  %-7s %2d/%d climbed, aligning %.2fs (sd %.2fs) %5.1f commands, left %.2f deg off (sd %.2f)" % (
+        name, climbed, count, statistics.mean(times), statistics.pstdev(times), statistics.mean(commands),
+        statistics.mean(headings), statistics.pstdev(headings)))
+
+def _main() -> None:
+    logging.disable(logging.CRITICAL)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    for noise in [float(arg) for arg in sys.argv[2:]] or [0.0, 0.5]:
+        print("Sensor noise %.1fcm" % noise)
+        bench("legacy", LegacyClimbController, count, noise)
+        bench("pid", climb.ClimbController, count, noise)
+
+if __name__ == "__main__":
+    _main()
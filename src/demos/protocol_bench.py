@@ -0,0 +1,65 @@
+"""
+Compares the framed protocol parser with the old string-splitting one, by
+flooding both with commands.
+
+Usage: python demos/protocol_bench.py (from the src directory)
+"""
+
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, ".")
+
+import protocol # pylint: disable=wrong-import-position
+
+COMMANDS = [b"forward\n", b"Lift Both\n", b"turn_left\n", b"stop all\n", b"subscribe 10\n"]
+
+class LegacyParser:
+    """The parser `SpencerServerConnection` used to use. Each message was then
+       split into words by `handle_message`, so we do that too.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+
+    def feed(self, data: bytes) -> List[List[str]]:
+        """Add some data to the stream, returning the words of any complete lines."""
+        messages = (self.buffer + data.decode()).split("\n")
+        self.buffer = messages.pop()
+        return [(message[:-1] if message.endswith("\r") else message).lower().split() for message in messages]
+
+def flood(count: int, chunk: int) -> List[bytes]:
+    """Build `count` commands, split into chunks of `chunk` bytes."""
+    stream = b"".join(COMMANDS[i % len(COMMANDS)] for i in range(count))
+    return [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+def long_line(size: int, chunk: int) -> List[bytes]:
+    """A single line of `size` bytes, which arrives in small chunks."""
+    stream = b"x" * size + b"\n"
+    return [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+def bench(name: str, make: Callable[[], object], chunks: List[bytes]) -> None:
+    """Time how long a parser takes to consume the given chunks."""
+    parser = make()
+    start = time.perf_counter()
+    messages = 0
+    for data in chunks:
+        messages += len(parser.feed(data)) # type: ignore
+    elapsed = time.perf_counter() - start
+    print("  %-8s %8.1fms  %d messages" % (name, elapsed * 1000, messages))
+
+def _main() -> None:
+    cases = [
+        ("Flood of 100k commands, 4KB chunks", flood(100000, 4096)),
+        ("Flood of 100k commands, 7 byte chunks", flood(100000, 7)),
+        ("One 256KB line, 64 byte chunks", long_line(256 * 1024, 64)),
+    ]
+    for title, chunks in cases:
+        print(title)
+        bench("legacy", LegacyParser, chunks)
+        # The long line is over the frame limit, so the new parser drops it.
+        bench("framed", protocol.FrameParser, chunks)
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,92 @@
+"""Streaming filters for noisy sensor readings.
+
+   Each reading passes through three stages:
+
+    - Outlier rejection: a reading further than `outlier` from the median of
+      the recent readings is dropped, unless `persist` readings in a row are,
+      in which case we assume the world really has changed and start again
+      from the new reading.
+    - A median over the last `window` accepted readings, which removes any
+      remaining single-sample spikes.
+    - Exponential smoothing of the median, by `alpha`.
+
+   Filters hold a fixed-size buffer, and are cheap enough to run in the sensor
+   callback threads.
+"""
+
+from array import array
+from typing import NamedTuple
+
+INF = float("inf")
+
+class FilterConfig(NamedTuple("FilterConfig", [("window", int), ("alpha", float), ("outlier", float),
+                                               ("persist", int)])):
+    """How to filter a sensor's readings.
+
+       `window` is the number of readings to take the median of, `alpha` the
+       weight given to each new median (1 disables smoothing) and `outlier` how
+       far (in the reading's units) a reading may be from the median before it
+       is rejected.
+    """
+
+# Filtering nothing at all.
+UNFILTERED = FilterConfig(window=1, alpha=1.0, outlier=INF, persist=1)
+
+class Filter:
+    """Filters a single sensor's readings. See the module documentation."""
+
+    def __init__(self, config: FilterConfig = UNFILTERED) -> None:
+        self.config = config
+        self.samples = array('d', [0.0] * max(1, config.window))
+        self.count = 0
+
+        self.raw = 0.0
+        self.value = 0.0
+        self.confidence = 0.0
+
+        # Readings rejected in a row, and in total.
+        self.run = 0
+        self.rejected = 0
+
+    def reset(self) -> None:
+        """Forget all previous readings, such as when the sensor goes out of range."""
+        self.count = 0
+        self.run = 0
+        self.confidence = 0.0
+
+    def median(self) -> float:
+        """The median of the readings currently held."""
+        ordered = sorted(self.samples[:min(self.count, len(self.samples))])
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+    def update(self, raw: float) -> bool:
+        """Add a new reading, returning False if it was rejected as an outlier."""
+        config = self.config
+        self.raw = raw
+
+        if self.count and abs(raw - self.median()) > config.outlier:
+            self.run += 1
+            self.rejected += 1
+            if self.run < config.persist:
+                self.confidence *= 1 - 1 / len(self.samples)
+                return False
+
+            # This has gone on long enough that it isn't an outlier.
+            self.reset()
+
+        self.run = 0
+        self.samples[self.count % len(self.samples)] = raw
+        self.count += 1
+
+        median = self.median()
+        self.value = median if self.count == 1 else self.value + config.alpha * (median - self.value)
+
+        # We trust a full window of readings which agree with each other.
+        held = min(self.count, len(self.samples))
+        spread = max(self.samples[:held]) - min(self.samples[:held])
+        agreement = 1.0 if config.outlier == INF else max(0.0, 1 - spread / (2 * config.outlier))
+        self.confidence = held / len(self.samples) * agreement
+        return True
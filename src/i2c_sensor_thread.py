@@ -1,32 +1,100 @@
 """Helper code for polling I2C touch sensors"""
 
-from threading import Thread
+from threading import Event, Thread
 import time
+from typing import Dict, Optional, Sequence
 
-import smbus2
-
+from autonomous_control import STEP_BACK, STEP_FRONT
+import bus
 from data import SensorData
+import motor
+
+# The fastest and slowest rates (as seconds between polls) to read the encoders.
+MIN_INTERVAL = 0.003
+MAX_INTERVAL = 0.05
+
+# How long (in seconds) the encoders must be still, with the lifting motors off,
+# before we start polling less often.
+IDLE_TIMEOUT = 0.25
 
 class RotaryEncoderThread(Thread):
-    """Polls the rotary encoder and updates the relevant sensors."""
-    def __init__(self, i2c_bus_no: int, address: int, data: SensorData) -> None:
+    """Polls the rotary encoder and updates the relevant sensors.
+
+       We poll quickly while the lifting mechanisms are moving (or being told
+       to move), so we have a precise position when it matters, and back off
+       to `max_interval` when idle.
+    """
+    def __init__(self, data: SensorData, address: int = bus.ENCODER_ADDRESS,
+                 min_interval: float = MIN_INTERVAL, max_interval: float = MAX_INTERVAL,
+                 motors: Sequence[int] = (STEP_FRONT, STEP_BACK)) -> None:
         self.address = address
-        self.bus = smbus2.SMBus(i2c_bus_no)
         self.data = data
 
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.motors = motors
+
+        self.interval = max_interval
+        self.last_active = 0.0
+
+        # Statistics on how often we actually poll.
+        self.polls = 0
+        self.last_poll = None # type: Optional[float]
+        self.period = max_interval
+
+        self.stopped = Event()
+
         super().__init__()
 
+    def poll(self) -> bool:
+        """Read the encoder deltas once, and apply them to the sensors. Returns
+           whether either encoder moved.
+        """
+        now = time.monotonic()
+        if self.last_poll is not None:
+            # Exponentially weighted average of the time between polls
+            self.period += 0.1 * (now - self.last_poll - self.period)
+        self.last_poll = now
+        self.polls += 1
+
+        moved = False
+        for i, val in enumerate(bus.read(self.address, 2)):
+            if val >= 128:
+                val = -256 + val
+            moved = moved or val != 0
+
+            if i == 1:
+                self.data.front_lifting_rot.change(val)
+            elif i == 0:
+                self.data.back_lifting_rot.change(val)
+
+        return moved
+
+    def next_interval(self, moved: bool, now: float) -> float:
+        """Work out how long to wait before the next poll."""
+        if moved or any(motor.commanded_speed(motor_id) != 0 for motor_id in self.motors):
+            self.last_active = now
+            self.interval = self.min_interval
+        elif now - self.last_active > IDLE_TIMEOUT:
+            self.interval = min(self.max_interval, self.interval * 2)
+
+        return self.interval
+
+    def stats(self) -> Dict[str, float]:
+        """Get statistics about how often we are polling."""
+        return {
+            "polls": self.polls,
+            "interval": self.interval,
+            "rate": 1 / self.period if self.period > 0 else 0,
+        }
+
+    def stop(self) -> None:
+        """Stop polling, waiting for the current poll to finish."""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
     def run(self):
-        while True:
-            msg = smbus2.i2c_msg.read(5, 2)
-            self.bus.i2c_rdwr(msg)
-            for i, val in enumerate(msg):
-                if val >= 128:
-                    val = -256 + val
-
-                if i == 1:
-                    self.data.front_lifting_rot.change(val)
-                elif i == 0:
-                    self.data.back_lifting_rot.change(val)
-
-            time.sleep(0.05)
+        while not self.stopped.is_set():
+            moved = self.poll()
+            self.stopped.wait(self.next_interval(moved, time.monotonic()))
@@ -0,0 +1,200 @@
+"""Timing instrumentation for the climbing routines.
+
+   While a `Run` is active, the routines mark which phase they are in (finding
+   the stair, lifting the front, and so on) with `phase`, and we record for
+   each phase:
+
+    - How long was spent in it.
+    - The interval between control loop iterations (each wait on the sensors
+      is one iteration), as a histogram.
+    - How many motor commands and I2C transactions were sent.
+    - The latency from a sensor reading changing to the next motor command
+      being sent.
+
+   Every hook is a no-op when no run is active, so the routines can be used
+   without any instrumentation.
+"""
+
+from collections import OrderedDict
+import math
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+
+INF = float("inf")
+
+# Upper bounds (in seconds) of the histogram buckets.
+INTERVAL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.5, INF)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, INF)
+
+class Histogram:
+    """A fixed-bucket histogram of durations, with summary statistics."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        """Record a single measurement."""
+        self.count += 1
+        self.total += value
+        self.squares += value * value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the count, mean, standard deviation, maximum and bucket counts."""
+        mean = self.total / self.count if self.count else 0.0
+        variance = self.squares / self.count - mean * mean if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean": mean,
+            "stdev": math.sqrt(max(0.0, variance)),
+            "max": self.max,
+            "histogram": {
+                ("<=%gms" % (bound * 1000) if bound != INF else "more"): count
+                for bound, count in zip(self.buckets, self.counts)
+            },
+        }
+
+class Phase:
+    """The statistics for one phase of a routine, over every time it was entered."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.entered = 0
+        self.duration = 0.0
+        self.commands = 0
+        self.transactions = 0
+        self.intervals = Histogram(INTERVAL_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get this phase's statistics."""
+        return {
+            "entered": self.entered,
+            "duration": self.duration,
+            "commands": self.commands,
+            "transactions": self.transactions,
+            "intervals": self.intervals.stats(),
+            "latency": self.latency.stats(),
+        }
+
+class Run:
+    """Instruments a single run of a routine, while used with `with`.
+
+       Durations are measured with `clock`, which can be swapped for a virtual
+       one in simulations. Latencies are always real time.
+    """
+
+    def __init__(self, name: str, clock: Callable[[], float] = time.monotonic) -> None:
+        self.name = name
+        self.clock = clock
+        self.phases = OrderedDict() # type: Dict[str, Phase]
+        self.current = None # type: Optional[Phase]
+        self.started = 0.0
+        self.entered = 0.0
+        self.finished = None # type: Optional[float]
+        self.last_tick = None # type: Optional[float]
+        self.last_actuation = 0.0
+
+    def enter(self, name: str) -> None:
+        """Finish the current phase, and start the named one."""
+        now = self.clock()
+        if self.current is not None:
+            self.current.duration += now - self.entered
+
+        current = self.phases.get(name)
+        if current is None:
+            current = self.phases[name] = Phase(name)
+        current.entered += 1
+        self.current = current
+        self.entered = now
+        self.last_tick = None
+
+    def tick(self) -> None:
+        """Mark the start of a control loop iteration."""
+        now = self.clock()
+        if self.last_tick is not None and self.current is not None:
+            self.current.intervals.add(now - self.last_tick)
+        self.last_tick = now
+
+    def actuated(self, commands: int) -> None:
+        """Record a transaction of motor commands being sent."""
+        current = self.current
+        if current is None:
+            return
+
+        current.commands += commands
+        current.transactions += 1
+
+        # Only the first command after a sensor changes can be a reaction to it.
+        changed = _LAST_CHANGE[0]
+        if changed > self.last_actuation:
+            now = time.monotonic()
+            current.latency.add(now - changed)
+            self.last_actuation = now
+
+    def summary(self) -> Dict[str, Any]:
+        """Get the statistics for every phase of this run."""
+        end = self.finished if self.finished is not None else self.clock()
+        return {
+            "routine": self.name,
+            "duration": end - self.started,
+            "ended": self.finished is not None,
+            "phases": {name: phase.stats() for name, phase in self.phases.items()},
+        }
+
+    def __enter__(self) -> "Run":
+        global _ACTIVE, _LAST # pylint: disable=global-statement
+        self.started = self.clock()
+        self.last_actuation = time.monotonic()
+        self.enter("starting")
+        _ACTIVE = _LAST = self
+        return self
+
+    def __exit__(self, _a: Any, _b: Any, _c: Any) -> None:
+        global _ACTIVE # pylint: disable=global-statement
+        if _ACTIVE is self:
+            _ACTIVE = None
+
+        self.finished = self.clock()
+        if self.current is not None:
+            self.current.duration += self.finished - self.entered
+            self.current = None
+
+_ACTIVE = None # type: Optional[Run]
+_LAST = None # type: Optional[Run]
+
+# When any sensor last changed (by time.monotonic). This is written from the
+# sensor threads.
+_LAST_CHANGE = [0.0]
+
+def phase(name: str) -> None:
+    """Mark the active run (if any) as entering the named phase."""
+    if _ACTIVE is not None:
+        _ACTIVE.enter(name)
+
+def tick() -> None:
+    """Mark the start of a control loop iteration in the active run."""
+    if _ACTIVE is not None:
+        _ACTIVE.tick()
+
+def sensor_changed() -> None:
+    """Note that a sensor reading has just changed."""
+    _LAST_CHANGE[0] = time.monotonic()
+
+def actuated(commands: int) -> None:
+    """Note that a transaction of motor commands has just been sent."""
+    if _ACTIVE is not None:
+        _ACTIVE.actuated(commands)
+
+def summary() -> Optional[Dict[str, Any]]:
+    """Get the statistics of the current run, or the last one if none is active."""
+    return _LAST.summary() if _LAST is not None else None
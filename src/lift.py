@@ -0,0 +1,178 @@
+"""Closed-loop position control for the lifting mechanisms.
+
+   Rather than running a mechanism at full speed until its encoder passes a
+   target and then braking, overshooting by however far it moved in the
+   meantime, `move_to` re-evaluates on every encoder poll and slows down as it
+   approaches the target.
+
+   `move_together` (or a `Coordinator`) moves both mechanisms at once. It
+   learns how fast each one actually moves, and slows down whichever would
+   otherwise arrive first, so they reach their targets at the same time.
+"""
+
+import logging
+import math
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from data import SensorData
+from sensor import Observable, RotaryEncoder, wait_any
+import autonomous_control as control
+
+LOG = logging.getLogger("lift")
+
+# How far (in encoder ticks) from the target we start slowing down, and the
+# slowest we drive the motors (as a fraction of full speed), below which they
+# stall under the weight of the robot.
+RAMP_TICKS = 60
+MIN_SPEED = 0.5
+
+# How close (in encoder ticks) to the target we must be to stop.
+TOLERANCE = 5
+
+# Speeds are rounded to this, so we don't send a motor command on every poll.
+SPEED_STEP = 0.1
+
+# The longest to wait between checks, should nothing change.
+SLEEP = 0.1
+
+# How much weight each new measurement of a mechanism's rate is given.
+RATE_SMOOTHING = 0.1
+
+# How fast (in encoder ticks per second at full speed) each mechanism has been
+# measured to move, by its name and whether the encoder is increasing. This is
+# kept between moves, as the load on each mechanism is much the same each time.
+RATES = {} # type: Dict[Tuple[str, bool], float]
+
+class Mechanism(NamedTuple("Mechanism", [("name", str), ("encoder", str), ("move", Callable[[float], None]),
+                                         ("stop", Callable[[], None])])):
+    """A lifting mechanism: the name of its encoder in `SensorData`, and the
+       commands to move and stop it. Positive speeds increase the encoder.
+    """
+
+FRONT = Mechanism("front", "front_lifting_rot", control.move_front, control.stop_front)
+BACK = Mechanism("back", "back_lifting_rot", control.move_back, control.stop_back)
+
+def ramp(remaining: float) -> float:
+    """The speed (from 0 to 1) to move at when `remaining` ticks from the target."""
+    speed = max(MIN_SPEED, min(1.0, abs(remaining) / RAMP_TICKS))
+    return round(speed / SPEED_STEP) * SPEED_STEP
+
+def approach(encoder: RotaryEncoder, target: float) -> float:
+    """The speed (from -1 to 1) to move a mechanism at to reach `target`, or 0
+       if it is already there.
+    """
+    # Look ahead by how late we may be to act, so we stop on the target rather
+    # than just after it.
+    remaining = target - encoder.predict(control.STOP_LEAD)
+    if abs(remaining) <= TOLERANCE:
+        return 0.0
+    return math.copysign(ramp(remaining), remaining)
+
+async def move_to(data: SensorData, mechanism: Mechanism, target: float,
+                  until: Optional[Callable[[], bool]] = None, watch: Sequence[Observable] = ()) -> bool:
+    """Move a lifting mechanism until its encoder reaches `target`, or until
+       `until` holds. This also wakes whenever any sensor in `watch` changes, so
+       `until` can depend on them.
+
+       Returns False if we were told to stop moving before getting there.
+    """
+    encoder = getattr(data, mechanism.encoder)
+    sensors = [encoder] + list(watch)
+    while data.get_moving():
+        speed = approach(encoder, target)
+        if speed == 0 or (until is not None and until()):
+            mechanism.stop()
+            LOG.debug("Moved %s to %d (target %d)", mechanism.name, encoder.get(), target)
+            return True
+
+        mechanism.move(speed)
+        await wait_any(sensors, SLEEP)
+
+    return False
+
+class Coordinator:
+    """Works out how fast to move several mechanisms so that they reach their
+       targets at the same time. Call `update` whenever an encoder changes.
+
+       The mechanism which will take longest moves at full speed, and the
+       others are slowed in proportion. This is worked out afresh from the
+       distance remaining on each update, so any drift is corrected as we go.
+    """
+
+    def __init__(self, data: SensorData, targets: Sequence[Tuple[Mechanism, float]]) -> None:
+        self.targets = targets
+        self.encoders = [getattr(data, mechanism.encoder) for mechanism, _ in targets] # type: List[RotaryEncoder]
+        self.speeds = [0.0] * len(targets)
+
+        # The speeds which were also commanded on the update before the last,
+        # so the encoders' velocities reflect them.
+        self.steady = [0.0] * len(targets)
+
+    def _learn(self) -> None:
+        """Update our estimate of each mechanism's rate, from those which have
+           been moving at a steady speed.
+        """
+        for (mechanism, _), encoder, speed in zip(self.targets, self.encoders, self.steady):
+            velocity = encoder.velocity()
+            if speed == 0 or velocity == 0 or (velocity > 0) != (speed > 0):
+                continue
+            key = (mechanism.name, speed > 0)
+            measured = velocity / speed
+            RATES[key] = RATES.get(key, measured) + RATE_SMOOTHING * (measured - RATES.get(key, measured))
+
+    def update(self) -> bool:
+        """Move each mechanism at the speed it should go at now. Returns True
+           (having stopped them) once they are all at their targets.
+        """
+        self._learn()
+
+        remaining = [target - encoder.predict(control.STOP_LEAD)
+                     for (_, target), encoder in zip(self.targets, self.encoders)]
+
+        # How long each mechanism would take at full speed. Until we know their
+        # rates, assume they are the same.
+        times = [0.0 if abs(ticks) <= TOLERANCE else abs(ticks) / RATES.get((mechanism.name, ticks > 0), 1.0)
+                 for (mechanism, _), ticks in zip(self.targets, remaining)]
+        longest = max(times)
+
+        speeds = []
+        for (mechanism, _), ticks, time in zip(self.targets, remaining, times):
+            if time == 0:
+                speed = 0.0
+                mechanism.stop()
+            else:
+                speed = max(MIN_SPEED, min(ramp(ticks), time / longest))
+                speed = math.copysign(round(speed / SPEED_STEP) * SPEED_STEP, ticks)
+                mechanism.move(speed)
+            speeds.append(speed)
+
+        self.steady = [new if new == old else 0.0 for new, old in zip(speeds, self.speeds)]
+        self.speeds = speeds
+        return longest == 0
+
+    def stop(self) -> None:
+        """Stop every mechanism."""
+        for mechanism, _ in self.targets:
+            mechanism.stop()
+        self.speeds = [0.0] * len(self.targets)
+        self.steady = [0.0] * len(self.targets)
+
+async def move_together(data: SensorData, targets: Sequence[Tuple[Mechanism, float]],
+                        until: Optional[Callable[[], bool]] = None, watch: Sequence[Observable] = ()) -> bool:
+    """Move several lifting mechanisms so they each reach their target at the
+       same time, or until `until` holds. See `move_to`.
+    """
+    coordinator = Coordinator(data, targets)
+    sensors = coordinator.encoders + list(watch) # type: List[Observable]
+    while data.get_moving():
+        if until is not None and until():
+            coordinator.stop()
+            return True
+        if coordinator.update():
+            LOG.debug("Moved %s to %s (targets %s)", ", ".join(mechanism.name for mechanism, _ in targets),
+                      [encoder.get() for encoder in coordinator.encoders], [target for _, target in targets])
+            return True
+
+        await wait_any(sensors, SLEEP)
+
+    return False
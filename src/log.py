@@ -2,7 +2,11 @@
 import asyncio
 import logging
 import logging.config
-from typing import Any, Dict
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 import warnings
 
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
@@ -36,15 +40,105 @@ class ColourFormatter(logging.Formatter):
             msg = "\033[1;3%dm%s\033[0m" % (COLOURS[record.levelname], msg)
         return msg
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Pushes log records onto a bounded queue, to be formatted and written by a
+       `QueueListener` on another thread.
+
+       Unlike the default `QueueHandler`, records are not formatted before being
+       queued, and are dropped (and counted) rather than blocking when the queue
+       is full.
+    """
+    def __init__(self, record_queue: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class RateLimitFilter(logging.Filter):
+    """Limits how many records per second each logger may emit. Warnings and
+       errors are never limited.
+    """
+    def __init__(self, limits: Dict[str, float]) -> None:
+        super().__init__()
+        self.limits = limits
+        self.dropped = 0
+
+        # Token buckets for each logger, holding the available tokens and when
+        # they were last refilled.
+        self.buckets = {} # type: Dict[str, Tuple[float, float]]
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        limit = self.limits.get(record.name)
+        if limit is None or record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(record.name, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now)
+                self.dropped += 1
+                return False
+
+            self.buckets[record.name] = (tokens - 1, now)
+            return True
+
 FORMAT = "[%(asctime)s] [%(levelname)s/%(name)s] %(message)s"
 
 HIDE_DEBUG = False
 
+# Whether to format and write log messages on a separate thread, so that logging
+# never blocks the sensor callbacks or the event loop.
+QUEUED = True
+
+# The maximum number of records waiting to be written, before we start dropping
+# them.
+QUEUE_SIZE = 10000
+
+# The maximum number of (non-warning) records per second for chatty loggers.
+RATE_LIMITS = {
+    "Sensors": 50,
+} # type: Dict[str, float]
+
+_LISTENER = None # type: Optional[logging.handlers.QueueListener]
+_QUEUE_HANDLER = None # type: Optional[DroppingQueueHandler]
+_RATE_LIMIT = None # type: Optional[RateLimitFilter]
+
+def stats() -> Dict[str, int]:
+    """Get the number of records which have been dropped from the queue or by the
+       rate limiter.
+    """
+    return {
+        "queue_dropped": _QUEUE_HANDLER.dropped if _QUEUE_HANDLER is not None else 0,
+        "rate_limited": _RATE_LIMIT.dropped if _RATE_LIMIT is not None else 0,
+    }
+
+def shutdown() -> None:
+    """Flush any queued log messages and stop the logging thread."""
+    global _LISTENER # pylint: disable=global-statement
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
+
 def configure() -> None:
     """Configure the root logger. This should be called once when the program is
        initialised.
 
+       If `QUEUED` is set, messages are passed to a background thread to be
+       written, and `shutdown` should be called before the program exits.
+
     """
+    global _LISTENER, _QUEUE_HANDLER, _RATE_LIMIT # pylint: disable=global-statement
+
     # Be more aggressive in capturing warnings
     logging.captureWarnings(True)
     warnings.simplefilter('default')
@@ -60,7 +154,7 @@ def configure() -> None:
     str_handler.setFormatter(col_formatter)
     str_handler.setLevel(logging.INFO if HIDE_DEBUG else logging.DEBUG)
 
-    logger.addHandler(str_handler)
+    handlers = [str_handler] # type: List[logging.Handler]
 
     # Register a custom formatter, which prints things
     # coloured with the time, level and coponent name.
@@ -72,4 +166,19 @@ def configure() -> None:
         file_handler.setFormatter(formatter)
         file_handler.setLevel(logging.DEBUG)
 
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    _RATE_LIMIT = RateLimitFilter(RATE_LIMITS)
+
+    if QUEUED:
+        record_queue = queue.Queue(QUEUE_SIZE) # type: queue.Queue[logging.LogRecord]
+        _QUEUE_HANDLER = DroppingQueueHandler(record_queue)
+        _QUEUE_HANDLER.addFilter(_RATE_LIMIT)
+        logger.addHandler(_QUEUE_HANDLER)
+
+        _LISTENER = logging.handlers.QueueListener(record_queue, *handlers, respect_handler_level=True)
+        _LISTENER.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(_RATE_LIMIT)
+            logger.addHandler(handler)
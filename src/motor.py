@@ -2,35 +2,218 @@
 A basic example of controlling a motor via smbus
 """
 
-import smbus2
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-BUS = smbus2.SMBus(1)
-ADDRESS = 0x04
+import bus
+import instrument
+import telemetry
+
+ADDRESS = bus.MOTOR_ADDRESS
 
 MODE_FLOAT = 0
 MODE_BRAKE = 1
 MODE_FWD = 2
 MODE_BKW = 3
 
+MOTOR_COUNT = 6
+
+# The telemetry channels for each motor. We record the commanded speed, with 0
+# for braking and NaN for floating.
+_CHANNELS = [telemetry.channel("motor_%d" % i) for i in range(MOTOR_COUNT)]
+
+# Commands identical to what the board was last sent are dropped, unless this
+# many seconds have passed since they were sent, in which case they are resent
+# as a keep-alive. Set to 0 to disable the cache entirely.
+REFRESH_INTERVAL = 1.0
+
+_LOCAL = threading.local()
+
+# The last command sent to each motor, and when it was sent.
+_SENT = {} # type: Dict[int, Tuple[List[int], float]]
+_SENT_LOCK = threading.Lock()
+
+def invalidate(motor_id: Optional[int] = None) -> None:
+    """Forget what we last sent to the given motor (or all motors), so the next
+       command to it is always written to the board.
+    """
+    with _SENT_LOCK:
+        if motor_id is None:
+            _SENT.clear()
+        else:
+            _SENT.pop(motor_id, None)
+
+def commanded_speed(motor_id: int) -> int:
+    """Get the speed the given motor was last told to spin at. This is 0 if it
+       was braked, floated, or we do not know.
+    """
+    with _SENT_LOCK:
+        last = _SENT.get(motor_id)
+    if last is None or len(last[0]) < 2:
+        return 0
+
+    command, speed = last[0]
+    return -speed if (command >> 1) & 3 == MODE_BKW else speed
+
+def _filter_sent(commands: Dict[int, List[int]]) -> Dict[int, List[int]]:
+    """Remove any commands which the board already holds, recording the remaining
+       ones as sent.
+    """
+    now = time.monotonic()
+    result = OrderedDict() # type: Dict[int, List[int]]
+    with _SENT_LOCK:
+        for motor_id, command in commands.items():
+            last = _SENT.get(motor_id)
+            if last is not None and last[0] == command and now - last[1] < REFRESH_INTERVAL:
+                continue
+
+            _SENT[motor_id] = (command, now)
+            result[motor_id] = command
+    return result
+
+def _forget_sent(commands: Dict[int, List[int]]) -> None:
+    """Forget that we sent some commands, as they never reached the board. Any
+       which have since been replaced by another command are left alone.
+    """
+    with _SENT_LOCK:
+        for motor_id, command in commands.items():
+            last = _SENT.get(motor_id)
+            if last is not None and last[0] == command:
+                del _SENT[motor_id]
+
+def _check_sent(commands: Dict[int, List[int]]) -> Callable[["Future[None]"], None]:
+    """Build a callback for a write's future, which forgets its commands if the
+       write failed or was discarded, so that retrying them is not skipped.
+    """
+    def check(future: "Future[None]") -> None:
+        if future.cancelled() or future.exception() is not None:
+            _forget_sent(commands)
+    return check
+
+def _speed_command(motor_id: int, speed: int) -> List[int]:
+    """Build the bytes which set a motor spinning at the given speed."""
+    mode = MODE_FWD if speed >= 0 else MODE_BKW
+    return [motor_id << 5 | mode << 1 | 24, abs(speed)]
+
+def _brake_command(motor_id: int) -> List[int]:
+    """Build the bytes which brake a motor."""
+    return [motor_id << 5 | MODE_BRAKE << 1]
+
+class MotorFrame:
+    """A batch of motor commands, which are sent to the motor board as a single
+       combined I2C transaction.
+
+       While a frame is open (using `with`), any calls to `set_motor` and
+       `stop_motor` on this thread are collected rather than sent, so several
+       motors change speed at the same instant. Later commands to the same motor
+       replace earlier ones. Nested frames simply join the outer one.
+    """
+
+    def __init__(self) -> None:
+        self.commands = OrderedDict() # type: Dict[int, List[int]]
+        self.parent = None # type: Optional[MotorFrame]
+
+    def set(self, motor_id: int, speed: int) -> 'MotorFrame':
+        """Queue a motor to spin. See `set_motor`."""
+        telemetry.record(_CHANNELS[motor_id], speed)
+        self.commands.pop(motor_id, None)
+        self.commands[motor_id] = _speed_command(motor_id, speed)
+        return self
+
+    def stop(self, motor_id: int) -> 'MotorFrame':
+        """Queue a motor to brake. See `stop_motor`."""
+        telemetry.record(_CHANNELS[motor_id], 0)
+        self.commands.pop(motor_id, None)
+        self.commands[motor_id] = _brake_command(motor_id)
+        return self
+
+    def flush(self, force: bool = False, priority: int = bus.MOTOR) -> None:
+        """Send all queued commands in one transaction, and clear the frame.
+
+           Commands which match what the board already holds are skipped, unless
+           `force` is set. The transaction is queued on the bus with the given
+           priority, so this does not wait for it to be sent.
+        """
+        if force:
+            with _SENT_LOCK:
+                now = time.monotonic()
+                for motor_id, command in self.commands.items():
+                    _SENT[motor_id] = (command, now)
+            commands = OrderedDict(self.commands) # type: Dict[int, List[int]]
+        else:
+            commands = _filter_sent(self.commands)
+        self.commands.clear()
+
+        if not commands:
+            return
+
+        try:
+            future = bus.write(ADDRESS, list(commands.values()), priority)
+        except Exception:
+            _forget_sent(commands)
+            raise
+        future.add_done_callback(_check_sent(commands))
+        instrument.actuated(len(commands))
+
+    def __enter__(self) -> 'MotorFrame':
+        self.parent = getattr(_LOCAL, "frame", None)
+        if self.parent is None:
+            _LOCAL.frame = self
+        return self
+
+    def __exit__(self, exc_type: Any, _b: Any, _c: Any) -> None:
+        if self.parent is not None:
+            # Hand our commands to the outer frame, which will send them.
+            for motor_id, command in self.commands.items():
+                self.parent.commands.pop(motor_id, None)
+                self.parent.commands[motor_id] = command
+            self.commands.clear()
+            self.parent = None
+            return
+
+        _LOCAL.frame = None
+        if exc_type is None:
+            self.flush()
+
+def _current_frame() -> Optional[MotorFrame]:
+    """Get the frame currently open on this thread, if any."""
+    return getattr(_LOCAL, "frame", None)
+
 def set_motor(motor_id: int, speed: int) -> None:
     """Sets a motor to spin. Any positive value is forwards, any negative one is
        backwards.
     """
-    mode = MODE_FWD if speed >= 0 else MODE_BKW
-    msg = smbus2.i2c_msg.write(ADDRESS, [motor_id << 5 | mode << 1 | 24, abs(speed)])
-    BUS.i2c_rdwr(msg)
+    frame = _current_frame()
+    if frame is not None:
+        frame.set(motor_id, speed)
+    else:
+        MotorFrame().set(motor_id, speed).flush()
 
 def stop_motor(motor_id: int) -> None:
     """Stops the given motor"""
-    # Mode 0 floats the motor.
-    BUS.write_byte(ADDRESS, motor_id << 5 | MODE_BRAKE << 1)
+    frame = _current_frame()
+    if frame is not None:
+        frame.stop(motor_id)
+    else:
+        MotorFrame().stop(motor_id).flush()
 
 def float_motors() -> None:
     """Stops all motors and allows them to coast."""
     # The motor board stops all motors if bit 0 is high.
-    BUS.write_byte(ADDRESS, 0x01)
+    invalidate()
+    for channel in _CHANNELS:
+        telemetry.record(channel, float("nan"))
+    bus.write_byte(ADDRESS, 0x01, bus.ESTOP)
 
 def stop_motors() -> None:
     """Stops all motors. Like, really hard."""
-    for i in range(6):
-        BUS.write_byte(ADDRESS, i << 5 | MODE_BRAKE << 1)
+    # We always send this, even if we believe the motors are already stopped,
+    # and it replaces whatever we previously thought the board held. It also
+    # jumps ahead of (and cancels) any commands still waiting to be sent.
+    frame = MotorFrame()
+    for i in range(MOTOR_COUNT):
+        frame.stop(i)
+    frame.flush(force=True, priority=bus.ESTOP)
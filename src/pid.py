@@ -0,0 +1,50 @@
+"""A PID controller, for turning a measured error into a motor speed."""
+
+from typing import NamedTuple, Optional
+
+INF = float("inf")
+
+class Gains(NamedTuple("Gains", [("kp", float), ("ki", float), ("kd", float), ("integral_limit", float)])):
+    """The gains of a PID controller.
+
+       `integral_limit` bounds the accumulated error (in error-seconds), so
+       that time spent saturated, or unable to move, cannot wind the integral
+       up into a large overshoot later.
+    """
+
+class PID:
+    """A PID controller, whose output is clamped to +/- `limit`.
+
+       The derivative is taken of the error, and is skipped on the first update
+       (or after a reset) as there is nothing to compare against.
+    """
+
+    def __init__(self, gains: Gains, limit: float = INF) -> None:
+        self.gains = gains
+        self.limit = limit
+
+        self.integral = 0.0
+        self.last_error = None # type: Optional[float]
+        self.last_time = None # type: Optional[float]
+
+    def reset(self) -> None:
+        """Forget all previous errors."""
+        self.integral = 0.0
+        self.last_error = None
+        self.last_time = None
+
+    def update(self, error: float, now: float) -> float:
+        """Get the output for an error measured at time `now` (in seconds)."""
+        gains = self.gains
+        derivative = 0.0
+        if self.last_time is not None and self.last_error is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            self.integral += error * elapsed
+            self.integral = max(-gains.integral_limit, min(gains.integral_limit, self.integral))
+            derivative = (error - self.last_error) / elapsed
+
+        self.last_error = error
+        self.last_time = now
+
+        output = gains.kp * error + gains.ki * self.integral + gains.kd * derivative
+        return max(-self.limit, min(self.limit, output))
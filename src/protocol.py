@@ -0,0 +1,195 @@
+"""Parses the stream of commands sent by clients.
+
+   Commands are usually lines of text terminated by "\\n" (with an optional
+   "\\r", for telnet). Clients may instead send length-prefixed frames: a 0x00
+   byte, followed by the length of the command as a big-endian 16-bit integer,
+   and then the command itself.
+"""
+
+import logging
+import struct
+from typing import Dict, List, NamedTuple, Tuple
+
+LOG = logging.getLogger("Network")
+
+# The longest command we accept, in bytes. Longer ones are discarded.
+MAX_FRAME = 1024
+
+# Clients send the same few commands over and over, so we remember how the most
+# common ones parse. Messages are immutable, so can be shared.
+CACHE_SIZE = 256
+_PARSED = {} # type: Dict[bytes, Message]
+
+BINARY_MARKER = 0
+BINARY_HEADER = struct.Struct(">BH")
+
+class Message(NamedTuple("Message", [("text", str), ("words", Tuple[str, ...])])):
+    """A command received from a client.
+
+       `text` is the command as sent (minus any line ending), and `words` is the
+       lower-cased command split on whitespace.
+    """
+
+    @property
+    def command(self) -> str:
+        """The first word of the command, or the empty string."""
+        return self.words[0] if self.words else ""
+
+    @property
+    def args(self) -> Tuple[str, ...]:
+        """Every word of the command after the first."""
+        return self.words[1:]
+
+def parse(text: str) -> Message:
+    """Parse a single command."""
+    if text.endswith("\r"):
+        text = text[:-1]
+    return Message(text, tuple(text.lower().split()))
+
+def parse_bytes(data: bytes) -> Message:
+    """Parse a single encoded command, reusing a previous result if possible."""
+    message = _PARSED.get(data)
+    if message is None:
+        message = parse(data.decode("utf-8", errors="replace"))
+        if len(_PARSED) < CACHE_SIZE:
+            _PARSED[data] = message
+    return message
+
+class FrameParser:
+    """Incrementally splits a stream of bytes into messages.
+
+       Data is appended to a single buffer, and we remember how far we have
+       already searched for a newline, so each byte is only scanned once no
+       matter how the stream is split up.
+    """
+
+    def __init__(self, max_frame: int = MAX_FRAME) -> None:
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        # How much of the buffer has been searched for a new line.
+        self.scanned = 0
+        # Set when discarding the rest of an over-long line.
+        self.discarding = False
+        # The number of bytes left to discard of an over-long binary frame.
+        self.skip = 0
+        self.dropped = 0
+
+    def _lines(self, data: bytes, messages: List[Message]) -> None:
+        """Parse a block of complete, newline separated lines."""
+        for line in data.split(b"\n"):
+            if len(line) > self.max_frame:
+                LOG.warning("Discarding line longer than %d bytes", self.max_frame)
+                self.dropped += 1
+            else:
+                messages.append(parse_bytes(line))
+
+    def _binary(self, start: int, messages: List[Message]) -> int:
+        """Parse a binary frame at `start`, returning where it ends or -1 if it is
+           incomplete.
+        """
+        buffer = self.buffer
+        if len(buffer) - start < BINARY_HEADER.size:
+            return -1
+
+        length = BINARY_HEADER.unpack_from(buffer, start)[1] # type: int
+        if length > self.max_frame:
+            LOG.warning("Discarding %d byte binary frame", length)
+            self.dropped += 1
+            self.skip = length
+            return start + BINARY_HEADER.size
+
+        end = start + BINARY_HEADER.size + length
+        if end > len(buffer):
+            return -1
+
+        messages.append(parse_bytes(bytes(buffer[start + BINARY_HEADER.size:end])))
+        return end
+
+    def feed(self, data: bytes) -> List[Message]:
+        """Add some data to the stream, returning any complete messages."""
+        if not data:
+            return []
+
+        self.buffer += data
+        if (self.buffer[0] != BINARY_MARKER and not self.skip and not self.discarding
+                and b"\x00" not in data):
+            return self._feed_text(len(data))
+        return self._feed_frames()
+
+    def _feed_text(self, size: int) -> List[Message]:
+        """Handle the common case of only text in the buffer, where only the last
+           `size` bytes can contain the end of a line.
+        """
+        buffer = self.buffer
+        messages = [] # type: List[Message]
+        end = buffer.rfind(b"\n", len(buffer) - size)
+        if end >= 0:
+            self._lines(bytes(buffer[:end]), messages)
+            del buffer[:end + 1]
+        if len(buffer) > self.max_frame:
+            LOG.warning("Discarding line longer than %d bytes", self.max_frame)
+            self.dropped += 1
+            self.discarding = True
+            del buffer[:]
+        self.scanned = len(buffer)
+        return messages
+
+    def _feed_frames(self) -> List[Message]:
+        """Handle a buffer containing binary frames, or part of a discarded one."""
+        buffer = self.buffer
+        messages = [] # type: List[Message]
+        start = 0
+        # How far into the buffer we have already searched, without finding the
+        # end of the current line.
+        scanned = self.scanned
+        self.scanned = 0
+        while start < len(buffer):
+            if self.skip:
+                skipped = min(self.skip, len(buffer) - start)
+                self.skip -= skipped
+                start += skipped
+                continue
+
+            if self.discarding:
+                end = buffer.find(b"\n", max(start, scanned))
+                if end < 0:
+                    start = len(buffer)
+                    break
+                self.discarding = False
+                start = end + 1
+                continue
+
+            if buffer[start] == BINARY_MARKER:
+                end = self._binary(start, messages)
+                if end < 0:
+                    break
+                start = end
+                continue
+
+            # Handle every complete line before the next binary frame at once.
+            # Text lines cannot contain a NUL byte, so a binary frame also ends
+            # any partial line before it.
+            marker = buffer.find(b"\x00", max(start, scanned))
+            limit = len(buffer) if marker < 0 else marker
+            end = buffer.rfind(b"\n", max(start, scanned), limit)
+            if end >= 0:
+                self._lines(bytes(buffer[start:end]), messages)
+                start = end + 1
+
+            if marker >= 0:
+                if start < marker:
+                    self._lines(bytes(buffer[start:marker]), messages)
+                start = marker
+                continue
+
+            if len(buffer) - start > self.max_frame:
+                LOG.warning("Discarding line longer than %d bytes", self.max_frame)
+                self.dropped += 1
+                self.discarding = True
+                start = len(buffer)
+            else:
+                self.scanned = len(buffer) - start
+            break
+
+        del buffer[:start]
+        return messages
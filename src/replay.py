@@ -0,0 +1,198 @@
+"""Runs the climbing routines against recorded (or synthetic) sensor traces,
+   without any hardware and faster than real time.
+
+   Routines are run on a `VirtualEventLoop`, whose clock only advances when
+   every task is waiting, so a run which would take a minute on the robot
+   finishes as soon as the CPU allows. Sensor readings from the trace are fed
+   into a `FakeSensorData` at their recorded times, and the commands sent to
+   the motor board are captured by a `RecordingBus`.
+
+   Usage: python replay.py telemetry.bin [climb|downstairs]
+"""
+
+import asyncio
+import logging
+import math
+import selectors
+import sys
+from typing import Any, Callable, Coroutine, List, NamedTuple, Optional, Sequence, Tuple
+
+import autonomous_control as control
+import bus
+import motor
+import telemetry
+from data import FakeSensorData, SENSORS
+
+Routine = Callable[[Any, Callable[[str], None]], Callable[[], Coroutine[Any, Any, None]]]
+
+class _VirtualSelector(selectors.SelectSelector):
+    """A selector which never blocks, instead advancing the loop's virtual clock
+       by however long it was asked to wait.
+    """
+    def __init__(self, loop: "VirtualEventLoop") -> None:
+        super().__init__()
+        self.virtual_loop = loop
+
+    def select(self, timeout: Optional[float] = None) -> List[Tuple[selectors.SelectorKey, int]]:
+        ready = super().select(0)
+        if ready:
+            return ready
+
+        if timeout is None:
+            raise RuntimeError("Virtual event loop has nothing left to run")
+
+        self.virtual_loop.now += max(0, timeout)
+        return ready
+
+class VirtualEventLoop(asyncio.SelectorEventLoop): # pylint: disable=abstract-method
+    """An event loop whose clock is simulated. Rather than sleeping, the loop
+       jumps straight to the next scheduled callback.
+    """
+    def __init__(self) -> None:
+        self.now = 0.0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now
+
+class MotorCommand(NamedTuple("MotorCommand", [("time", float), ("motor", int), ("mode", int), ("speed", int)])):
+    """A single command sent to the motor board."""
+
+class RecordingBus(bus.Backend):
+    """A bus backend which records all commands sent to the motor board."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.commands = [] # type: List[MotorCommand]
+        self.transactions = 0
+
+    def _record(self, data: List[int]) -> None:
+        now = self.loop.time()
+        if data[0] & 1:
+            # Float all motors
+            for motor_id in range(motor.MOTOR_COUNT):
+                self.commands.append(MotorCommand(now, motor_id, motor.MODE_FLOAT, 0))
+            return
+
+        motor_id, mode = data[0] >> 5, (data[0] >> 1) & 3
+        speed = data[1] if len(data) > 1 else 0
+        self.commands.append(MotorCommand(now, motor_id, mode, -speed if mode == motor.MODE_BKW else speed))
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        """Record a combined transaction."""
+        self.transactions += 1
+        for block in blocks:
+            self._record(list(block))
+
+    def read(self, address: int, length: int) -> List[int]:
+        """The encoders never move, as their readings come from the trace."""
+        return [0] * length
+
+class Event(NamedTuple("Event", [("time", float), ("sensor", str), ("value", float)])):
+    """A single sensor reading in a trace. NaN values mark invalid readings."""
+
+class Trace:
+    """A timeline of sensor readings, relative to the start of the run."""
+
+    def __init__(self, events: Optional[List[Event]] = None) -> None:
+        self.events = sorted(events or [], key=lambda event: event.time)
+
+    def at(self, time: float, sensor: str, value: float) -> "Trace":
+        """Add a reading to this trace."""
+        if sensor not in SENSORS:
+            raise ValueError("Unknown sensor %s" % sensor)
+
+        self.events.append(Event(time, sensor, value))
+        self.events.sort(key=lambda event: event.time)
+        return self
+
+    @staticmethod
+    def from_telemetry(path: str) -> "Trace":
+        """Load the sensor readings from a telemetry dump. Motor commands and
+           unknown channels are ignored.
+        """
+        names, times, channels, values = telemetry.load(path)
+        if not times:
+            return Trace()
+
+        start = times[0]
+        return Trace([Event(times[i] - start, names[channel], values[i])
+                      for i, channel in enumerate(channels) if names[channel] in SENSORS])
+
+class ReplayResult(NamedTuple("ReplayResult", [
+        ("duration", float), ("finished", bool), ("commands", List[MotorCommand]),
+        ("transactions", int), ("progress", List[Tuple[float, str]])])):
+    """The result of replaying a routine.
+
+       `duration` is the simulated time the routine took, and `finished` is
+       False if it was stopped for running too long.
+    """
+
+def _reset_control() -> None:
+    """Reset any global state left over from a previous run."""
+    for machine in control.STATES:
+        control.STATES[machine] = "_"
+    motor.invalidate()
+
+def run(routine: Routine, trace: Trace, timeout: float = 600,
+        data: Optional[FakeSensorData] = None) -> ReplayResult:
+    """Run a routine (such as `autonomous_control.climb_`) against a trace.
+
+       The routine is abandoned after `timeout` seconds of simulated time.
+    """
+    loop = VirtualEventLoop()
+    recording = RecordingBus(loop)
+    data = data if data is not None else FakeSensorData()
+    progress = [] # type: List[Tuple[float, str]]
+
+    def set_sensor(event: Event) -> None:
+        sensor = getattr(data, event.sensor)
+        if math.isnan(event.value):
+            sensor.set(sensor.get(), False)
+        else:
+            sensor.set(event.value)
+
+    old_backend = bus.use(recording)
+    try:
+        _reset_control()
+        asyncio.set_event_loop(loop)
+        data.set_moving(True)
+
+        for event in trace.events:
+            # Readings at the start are applied immediately, so the routine sees
+            # them on its first step.
+            if event.time <= 0:
+                set_sensor(event)
+            else:
+                loop.call_at(event.time, set_sensor, event)
+
+        task = loop.create_task(routine(data, lambda msg: progress.append((loop.time(), msg)))())
+        try:
+            loop.run_until_complete(asyncio.wait_for(task, timeout))
+            finished = True
+        except asyncio.TimeoutError:
+            finished = False
+
+        return ReplayResult(loop.time(), finished, recording.commands, recording.transactions, progress)
+    finally:
+        bus.use(old_backend)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def _main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    routine = control.downstairs_ if len(sys.argv) > 2 and sys.argv[2] == "downstairs" else control.climb_
+    result = run(routine, Trace.from_telemetry(sys.argv[1]))
+    for time, message in result.progress:
+        print("%8.3f %s" % (time, message))
+    print("%s after %.3fs, with %d motor commands in %d transactions" % (
+        "Finished" if result.finished else "Timed out", result.duration,
+        len(result.commands), result.transactions))
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,130 @@
+"""Supervises long-running routines, such as climbing the stairs.
+
+   At most one routine runs at a time. Starting another routine (or stopping)
+   cancels the current one, which raises `CancelledError` wherever it is
+   waiting, so it stops immediately rather than when it next checks whether it
+   should still be moving. Whichever way a routine ends, the motors are braked.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+import autonomous_control as control
+import instrument
+
+LOG = logging.getLogger("Routine")
+
+class Latency:
+    """Running statistics on how long something takes, in seconds."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        """Record a single measurement."""
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self) -> Dict[str, float]:
+        """Get the number, mean and maximum of the measurements."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+class Supervisor:
+    """Owns the currently running routine, if any.
+
+       State changes ("Running climb", "Finished climb", "Cancelled climb" or
+       "Failed climb") are passed to `report`. Each routine is instrumented
+       (see `instrument.Run`), and once it ends a summary is reported as a line
+       of JSON, such as `{"summary": {"routine": "climb", ...}}`.
+    """
+
+    def __init__(self, report: Callable[[str], None]) -> None:
+        self.report = report
+        self.name = None # type: Optional[str]
+        self.task = None # type: Optional[asyncio.Future[None]]
+
+        # From a routine being requested to it starting, and from it being
+        # cancelled to the motors being braked.
+        self.start_latency = Latency()
+        self.stop_latency = Latency()
+
+    @property
+    def active(self) -> bool:
+        """Whether a routine is currently running."""
+        return self.task is not None and not self.task.done()
+
+    async def start(self, name: str, routine: Coroutine[Any, Any, None],
+                    requested: Optional[float] = None) -> None:
+        """Cancel the current routine, and then start a new one. `requested` is
+           the loop time when the routine was asked for.
+        """
+        loop = asyncio.get_event_loop()
+        if requested is None:
+            requested = loop.time()
+
+        await self.cancel(requested)
+        self.name = name
+        self.task = asyncio.ensure_future(self._run(name, routine, requested))
+
+    async def cancel(self, requested: Optional[float] = None) -> bool:
+        """Cancel the current routine, waiting until it has stopped. Returns
+           False if nothing was running.
+        """
+        task = self.task
+        if task is None or task.done():
+            return False
+
+        loop = asyncio.get_event_loop()
+        if requested is None:
+            requested = loop.time()
+
+        task.cancel()
+        await asyncio.wait([task])
+
+        latency = loop.time() - requested
+        self.stop_latency.add(latency)
+        LOG.debug("Stopped %s in %.1fms", self.name, latency * 1000)
+        return True
+
+    async def _run(self, name: str, routine: Coroutine[Any, Any, None], requested: float) -> None:
+        latency = asyncio.get_event_loop().time() - requested
+        self.start_latency.add(latency)
+        LOG.debug("Started %s in %.1fms", name, latency * 1000)
+        self.report("Running " + name)
+
+        outcome = "Failed"
+        run = instrument.Run(name)
+        try:
+            with run:
+                await routine
+            outcome = "Finished"
+        except asyncio.CancelledError:
+            outcome = "Cancelled"
+            raise
+        except Exception: # pylint: disable=broad-except
+            LOG.exception("Routine %s failed", name)
+        finally:
+            control.brake()
+            LOG.info("%s %s", outcome, name)
+            self.report("%s %s" % (outcome, name))
+
+            summary = run.summary()
+            LOG.info("Timings for %s: %s", name, summary)
+            self.report(json.dumps({"summary": summary}))
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the start and stop latency of routines."""
+        return {
+            "active": self.name if self.active else None,
+            "start": self.start_latency.stats(),
+            "stop": self.stop_latency.stats(),
+        }
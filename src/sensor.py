@@ -1,18 +1,30 @@
 """Helper methods for interfacing with Phidget sensors."""
 
+from array import array
+import asyncio
+from collections import OrderedDict
 import logging
 import threading
-from typing import Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 import time
 
 
 from Phidget22.Devices.VoltageRatioInput import VoltageRatioInput, VoltageRatioSensorType
 from Phidget22.Devices.DigitalInput import DigitalInput
 
+from filters import Filter, FilterConfig, UNFILTERED
+import instrument
+import telemetry
+
 LOG = logging.getLogger("Sensors")
 
 ATTACHMENT_TIMEOUT = 1000
 
+# The default interval (in ms) between distance readings, and an interval
+# meaning as fast as the device allows.
+DATA_INTERVAL = 50
+FASTEST = 0
+
 def current_milli_time() -> int:
     """Get the current time in milliseconds"""
     return int(round(time.time() * 1000))
@@ -33,14 +45,263 @@ def setup(factory, channel):
     ph.setOnErrorHandler(on_error)
     return ph
 
-class Touch:
+Predicate = Callable[[Any], bool]
+
+class SensorTable:
+    """A compact table holding the latest value of a set of sensors, which can
+       be copied as a whole without taking any locks.
+
+       This is a seqlock: writers (the sensor callback threads) bump `version`
+       to an odd number, write, and bump it back to an even number. Readers
+       copy the table and retry if the version was odd or changed meanwhile, so
+       they always see every sensor as it was at a single instant.
+    """
+
+    def __init__(self, names: Sequence[str]) -> None:
+        self.names = tuple(names)
+        self.values = array('d', [0.0] * len(self.names))
+        self.valid = array('b', [0] * len(self.names))
+        self.version = 0
+
+        # Writers still need to be serialised against each other.
+        self._write_lock = threading.Lock()
+
+    def write(self, slot: int, value: float, valid: bool) -> None:
+        """Update a single sensor's entry in the table."""
+        with self._write_lock:
+            self.version += 1
+            self.values[slot] = value
+            self.valid[slot] = valid
+            self.version += 1
+
+    def read(self) -> Tuple[int, "array[float]", "array[int]"]:
+        """Copy the whole table, returning its version, values and validity."""
+        while True:
+            version = self.version
+            if version & 1:
+                time.sleep(0)
+                continue
+
+            values = self.values[:]
+            valid = self.valid[:]
+            if self.version == version:
+                return version, values, valid
+
+class _Waiter:
+    """A coroutine waiting on one or more sensors."""
+    __slots__ = ("predicate", "future", "loop")
+
+    def __init__(self, predicate: Optional[Predicate], future: "asyncio.Future[Any]",
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self.predicate = predicate
+        self.future = future
+        self.loop = loop
+
+class Observable:
+    """A sensor which coroutines may wait on.
+
+       Subclasses call `_notify` whenever their value changes. This may be done
+       from any thread (such as a Phidget callback or the encoder thread), and
+       wakes waiting coroutines on their own event loop.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._channel = telemetry.channel(name)
+
+        self._waiters = [] # type: List[_Waiter]
+        self._waiters_lock = threading.Lock()
+
+        self._table = None # type: Optional[SensorTable]
+        self._slot = 0
+
+    def bind(self, table: SensorTable, slot: int) -> None:
+        """Publish this sensor's readings into the given slot of `table`."""
+        self._table = table
+        self._slot = slot
+        table.write(slot, getattr(self, "value"), bool(getattr(self, "valid", True)))
+
+    def _publish(self, value: float, valid: Optional[bool]) -> None:
+        """Record a new reading, and write it to our sensor table if we have one.
+           This should be called while holding the sensor's lock, so updates are
+           written in order.
+        """
+        telemetry.record(self._channel, value if valid else float("nan"))
+        instrument.sensor_changed()
+        if self._table is not None:
+            self._table.write(self._slot, value, bool(valid))
+
+    def get(self) -> Any:
+        """Get the current value of this sensor."""
+        raise NotImplementedError()
+
+    def _notify(self) -> None:
+        """Wake any coroutines waiting on this sensor."""
+        with self._waiters_lock:
+            if not self._waiters:
+                return
+            loops = {waiter.loop for waiter in self._waiters}
+
+        for loop in loops:
+            loop.call_soon_threadsafe(self._check_waiters, loop)
+
+    def _check_waiters(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Resolve any waiters on `loop` whose condition now holds."""
+        value = self.get()
+        with self._waiters_lock:
+            for waiter in self._waiters:
+                if waiter.loop is not loop or waiter.future.done():
+                    continue
+                if waiter.predicate is None or waiter.predicate(value):
+                    waiter.future.set_result(value)
+
+    def _add_waiter(self, waiter: _Waiter) -> None:
+        with self._waiters_lock:
+            self._waiters.append(waiter)
+
+    def _remove_waiter(self, waiter: _Waiter) -> None:
+        with self._waiters_lock:
+            self._waiters.remove(waiter)
+
+    async def wait_until(self, predicate: Predicate, timeout: Optional[float] = None) -> bool:
+        """Wait until `predicate` holds for this sensor's value. Returns False if
+           we timed out before this happened.
+        """
+        instrument.tick()
+        loop = asyncio.get_event_loop()
+        waiter = _Waiter(predicate, loop.create_future(), loop)
+        self._add_waiter(waiter)
+        try:
+            # Check after registering, so we cannot miss a change in between.
+            if predicate(self.get()):
+                return True
+
+            done, _ = await asyncio.wait([waiter.future], timeout=timeout)
+            return bool(done)
+        finally:
+            self._remove_waiter(waiter)
+            waiter.future.cancel()
+
+    async def wait_for(self, value: Any, timeout: Optional[float] = None) -> bool:
+        """Wait until this sensor has the given value. Returns False if we timed
+           out before this happened.
+        """
+        return await self.wait_until(lambda x: x == value, timeout)
+
+async def wait_any(sensors: Iterable[Observable], timeout: Optional[float] = None) -> bool:
+    """Wait until any of the given sensors change. Returns False if we timed out
+       before this happened.
+
+       This is intended as a drop-in replacement for sleeping in a control loop:
+       the loop re-evaluates as soon as anything it depends on changes, but still
+       wakes up after `timeout` so it can check other conditions.
+    """
+    instrument.tick()
+    loop = asyncio.get_event_loop()
+    waiter = _Waiter(None, loop.create_future(), loop)
+    sensors = list(sensors)
+    for sensor in sensors:
+        sensor._add_waiter(waiter) # pylint: disable=protected-access
+    try:
+        done, _ = await asyncio.wait([waiter.future], timeout=timeout)
+        return bool(done)
+    finally:
+        for sensor in sensors:
+            sensor._remove_waiter(waiter) # pylint: disable=protected-access
+        waiter.future.cancel()
+
+class PhidgetSensor(Observable): # pylint: disable=abstract-method
+    """A sensor read through a Phidget channel.
+
+       Opening the channel does not wait for the device, which attaches in the
+       background (and re-attaches if it is unplugged). This lets `attach` open
+       every sensor at once, rather than waiting for each in turn.
+    """
+
+    phidget = None # type: Any
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.attached = threading.Event()
+        self.attached_at = None # type: Optional[float]
+
+        # Statistics on how often the device calls us back.
+        self.callbacks = 0
+        self.last_callback = None # type: Optional[float]
+        self.period = 0.0
+
+    def open(self) -> None:
+        """Start attaching to the device, without waiting for it."""
+        self.phidget.setOnAttachHandler(self._on_attach)
+        self.phidget.open()
+
+    def configure(self) -> None:
+        """Set up the channel once it is attached."""
+
+    def _on_attach(self, _: Any) -> None:
+        self.configure()
+        if self.attached_at is None:
+            self.attached_at = time.monotonic()
+        self.attached.set()
+        LOG.info("Attached %s", self.name)
+
+    def _called_back(self) -> None:
+        """Note that the device has sent us a reading."""
+        now = time.monotonic()
+        if self.last_callback is not None:
+            # Exponentially weighted average of the time between callbacks
+            elapsed = now - self.last_callback
+            self.period = elapsed if self.callbacks == 1 else self.period + 0.1 * (elapsed - self.period)
+        self.last_callback = now
+        self.callbacks += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics about how often the device is sending readings."""
+        return {
+            "callbacks": self.callbacks,
+            "rate": 1 / self.period if self.period > 0 else 0.0,
+        }
+
+    def close(self) -> None:
+        """Stop listening to the device."""
+        self.phidget.setOnErrorHandler(None)
+        self.phidget.setOnAttachHandler(None)
+        self.phidget.close()
+
+    def __enter__(self):
+        self.open()
+        if not self.attached.wait(ATTACHMENT_TIMEOUT / 1000):
+            self.close()
+            raise IOError("%s did not attach" % self.name)
+        return self
+
+    def __exit__(self, _a, _b, _c):
+        self.close()
+
+def attach(sensors: Sequence[PhidgetSensor], timeout: float) -> Dict[str, Optional[float]]:
+    """Open every sensor at once, waiting at most `timeout` seconds in total for
+       them to attach. Returns how long each took to attach, or None for those
+       which did not. Sensors are left open either way, so should be closed.
+    """
+    start = time.monotonic()
+    for sensor in sensors:
+        sensor.open()
+
+    deadline = start + timeout
+    for sensor in sensors:
+        sensor.attached.wait(max(0.0, deadline - time.monotonic()))
+
+    return OrderedDict((sensor.name, sensor.attached_at - start if sensor.attached_at is not None else None)
+                       for sensor in sensors)
+
+class Touch(PhidgetSensor):
     """A glorified wrapper over the touch sensor."""
     name = None # type: str
     value = None # type: int
     valid = None # type: bool
 
     def __init__(self, name: str, channel: int):
-        self.name = name
+        super().__init__(name)
         self.value = 0
         self.valid = False
 
@@ -55,10 +316,13 @@ class Touch:
 
     def _on_change(self, _, state):
         "Callback for when the sensor's input is changed."""
+        self._called_back()
         LOG.debug("%s = %s", self.name, state)
         with self.lock:
             self.valid = True
             self.value = state
+            self._publish(state == 1, True)
+        self._notify()
 
     def get(self) -> bool:
         """ Returns the value of the sensors data """
@@ -73,18 +337,12 @@ class Touch:
         with self.lock:
             self.valid = True
             self.value = value
+            self._publish(value == 1, True)
+        self._notify()
 
-    def __enter__(self):
-        """Attach this sensor and configure it with various properties.
-
-        """
-        self.phidget.openWaitForAttachment(ATTACHMENT_TIMEOUT)
-        LOG.info("Attached %s", self.name)
-
-    def __exit__(self, _a, _b, _c):
-        self.phidget.setOnErrorHandler(None)
+    def close(self) -> None:
         self.phidget.setOnStateChangeHandler(None)
-        self.phidget.close()
+        super().close()
 
 class TouchSensorsI2c:
     """A touch sensor from the I2C expansion board."""
@@ -122,34 +380,62 @@ class TouchSensorsI2c:
                 LOG.debug("%s = %s", self.name, value)
 
 
-class Distance:
-    """A glorified wrapper over the distance sensor."""
+class Distance(PhidgetSensor):
+    """A glorified wrapper over the distance sensor.
+
+       Readings are passed through a `Filter`, configured by `config`. The
+       filtered reading is the sensor's value, but the raw reading and how
+       confident the filter is in its value are also available.
+    """
 
     name = None # type: str
     value = None # type: float
     valid = None # type: Optional[bool]
 
-    def __init__(self, name: str, channel: int):
-        self.name = name
+    def __init__(self, name: str, channel: int, config: FilterConfig = UNFILTERED,
+                 interval: int = DATA_INTERVAL):
+        super().__init__(name)
         self.value = 0
         self.valid = None
 
         self.lock = threading.Lock()
+        self.filter = Filter(config)
+        self._raw_channel = telemetry.channel(name + ".raw")
+
+        # The requested interval between readings, and the one the device is
+        # actually using (once attached).
+        self.interval = interval
+        self.actual_interval = None # type: Optional[int]
+        self._interval_lock = threading.RLock()
+        self._interval_channel = telemetry.channel(name + ".interval")
 
         self.phidget = VoltageRatioInput()
         self.phidget.setChannel(channel)
         self.phidget.setOnSensorChangeHandler(self._on_change)
         self.phidget.setOnErrorHandler(self._on_error)
 
-    def _on_change(self, _, value, _unit):
+    def _on_change(self, _, raw, _unit):
         "Callback for when the sensor's input is changed."""
+        self._called_back()
+        telemetry.record(self._raw_channel, raw)
         with self.lock:
+            if not self.filter.update(raw):
+                return
+
+            value = self.filter.value
             if not self.valid or abs(self.value - value) > 0.05:
                 # Update properties and notify observers
                 if self.name == "front_dist_0" or self.name == "front_dist_1":
                     LOG.debug("%s = %s%s", self.name, value, _unit.symbol)
                 self.value = value
                 self.valid = True
+                self._publish(value, True)
+                changed = True
+            else:
+                changed = False
+
+        if changed:
+            self._notify()
 
     def get(self) -> float:
         """ Returns the value of the sensors data """
@@ -162,6 +448,16 @@ class Distance:
         with self.lock:
             return self.valid
 
+    def get_raw(self) -> float:
+        """Get the last reading, before it was filtered."""
+        with self.lock:
+            return self.filter.raw
+
+    def get_confidence(self) -> float:
+        """How much we trust the current value, from 0 (not at all) to 1."""
+        with self.lock:
+            return self.filter.confidence if self.valid else 0.0
+
     def _on_error(self, ph, code, msg):
         """Callback for when the sensor detects receives an error.
 
@@ -172,66 +468,198 @@ class Distance:
         if code == 4103:
             # Mark as malformed and notify observers
             with self.lock:
-                if self.valid or self.valid is None:
+                changed = self.valid or self.valid is None
+                self.filter.reset()
+                if changed:
                     LOG.warning("%s is out of bounds", self.name)
                     self.valid = False
+                    self._publish(self.value, False)
+
+            if changed:
+                self._notify()
         else:
             on_error(ph, code, msg)
 
-    def __enter__(self):
-        """Attach this sensor and configure it with various properties.
-
-           For now, we subscribe to updates every 50ms (20Hz).
+    def configure(self) -> None:
+        """We want every reading, even if unchanged, so the filter is never left
+           waiting on one it has rejected.
         """
-        self.phidget.openWaitForAttachment(ATTACHMENT_TIMEOUT)
-        self.phidget.setDataInterval(50)
+        self._apply_interval(force=True)
         self.phidget.setSensorType(VoltageRatioSensorType.SENSOR_TYPE_1101_SHARP_2D120X)
-        LOG.info("Attached %s", self.name)
+        self.phidget.setSensorValueChangeTrigger(0)
+
+    def _apply_interval(self, force: bool = False) -> None:
+        # This has its own lock, as we must not hold up the callbacks while
+        # talking to the device.
+        with self._interval_lock:
+            phidget = self.phidget
+            interval = min(max(self.interval, phidget.getMinDataInterval()), phidget.getMaxDataInterval())
+            if interval == self.actual_interval and not force:
+                return
+
+            phidget.setDataInterval(interval)
+            self.actual_interval = interval
+        telemetry.record(self._interval_channel, interval)
+
+    def set_interval(self, interval: int) -> int:
+        """Ask for a reading every `interval` ms, `FASTEST` being as often as the
+           device allows. This may be called at any time, from any thread.
+           Returns the previously requested interval.
+        """
+        with self._interval_lock:
+            previous, self.interval = self.interval, interval
+        if self.attached.is_set():
+            self._apply_interval()
+        return previous
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["interval"] = self.actual_interval
+        return stats
+
+    def close(self) -> None:
+        self.phidget.setOnSensorChangeHandler(None)
+        super().close()
 
-        return self
+# The number of samples used to estimate an encoder's velocity.
+ENCODER_WINDOW = 8
 
-    def __exit__(self, _a, _b, _c):
-        self.phidget.setOnErrorHandler(None)
-        self.phidget.setOnSensorChangeHandler(None)
-        self.phidget.close()
+class RotaryEncoder(Observable):
+    """A rotary encoder sensor.
+
+       As well as the position, we keep the last `ENCODER_WINDOW` samples in a
+       ring buffer, from which we estimate the encoder's velocity and
+       acceleration and extrapolate its position between polls.
 
-class RotaryEncoder:
-    """A rotary encoder sensor"""
+       The encoder board reports signed 8-bit deltas, so moving more than 127
+       ticks between polls wraps around. If a delta disagrees wildly with our
+       current velocity, but would agree once unwrapped, we assume it has
+       wrapped and count it in `overflows`.
+    """
 
     name = None # type: str
     value = None # type: int
     lock = None # type: threading.Lock
 
     def __init__(self, name: str) -> None:
-        self.name = name
+        super().__init__(name)
         self.value = 0
         self.lock = threading.Lock()
 
+        # The clock used to timestamp samples. This may be replaced when running
+        # on a simulated clock.
+        self.clock = time.monotonic # type: Callable[[], float]
+
+        self.overflows = 0
+        self._times = array('d', [0.0] * ENCODER_WINDOW)
+        self._positions = array('d', [0.0] * ENCODER_WINDOW)
+        self._samples = 0
+
     def get(self) -> int:
         """Get the current value of this rotary encoder."""
         with self.lock:
             return self.value
 
+    def _sample(self, age: int) -> Tuple[float, float]:
+        """Get the time and position of a sample, 0 being the newest."""
+        index = (self._samples - 1 - age) % ENCODER_WINDOW
+        return self._times[index], self._positions[index]
+
+    def _velocity(self, newest: int, oldest: int) -> float:
+        """Estimate the velocity between two samples, in ticks per second."""
+        new_time, new_pos = self._sample(newest)
+        old_time, old_pos = self._sample(oldest)
+        if new_time <= old_time:
+            return 0.0
+        return (new_pos - old_pos) / (new_time - old_time)
+
+    def _window(self) -> int:
+        """The number of samples currently held."""
+        return min(self._samples, ENCODER_WINDOW)
+
+    def velocity(self) -> float:
+        """Estimate how fast the encoder is moving, in ticks per second."""
+        with self.lock:
+            window = self._window()
+            return self._velocity(0, window - 1) if window >= 2 else 0.0
+
+    def acceleration(self) -> float:
+        """Estimate the encoder's acceleration, in ticks per second squared."""
+        with self.lock:
+            window = self._window()
+            if window < 4:
+                return 0.0
+
+            half = window // 2
+            recent = self._velocity(0, half - 1)
+            older = self._velocity(half, window - 1)
+            elapsed = (self._sample(0)[0] + self._sample(half - 1)[0] -
+                       self._sample(half)[0] - self._sample(window - 1)[0]) / 2
+            return (recent - older) / elapsed if elapsed > 0 else 0.0
+
+    def predict(self, ahead: float = 0.0) -> float:
+        """Extrapolate where the encoder will be `ahead` seconds from now,
+           assuming it keeps moving at its current velocity.
+        """
+        velocity = self.velocity()
+        with self.lock:
+            if self._samples == 0:
+                return self.value
+            last_time = self._sample(0)[0]
+            return self.value + velocity * (self.clock() - last_time + ahead)
+
     def change(self, delta: int) -> None:
-        """Increment the encoder's value"""
-        if delta != 0:
-            with self.lock:
-                self.value += delta
+        """Increment the encoder's value. This should be called on every poll,
+           even if the encoder did not move, so our velocity estimate is kept
+           up to date.
+        """
+        now = self.clock()
+        with self.lock:
+            if self._window() >= 2:
+                last_time = self._sample(0)[0]
+                expected = self._velocity(0, self._window() - 1) * (now - last_time)
+                unwrapped = delta + 256 if delta < 0 else delta - 256
+                if abs(delta - expected) > 128 and abs(unwrapped - expected) < abs(delta - expected):
+                    LOG.warning("%s overflowed (read %d, expected around %d)", self.name, delta, expected)
+                    self.overflows += 1
+                    delta = unwrapped
+
+            self.value += delta
+            index = self._samples % ENCODER_WINDOW
+            self._times[index] = now
+            self._positions[index] = self.value
+            self._samples += 1
+
+            if delta != 0:
+                self._publish(self.value, True)
                 LOG.debug("%s = %d", self.name, self.value)
 
+        if delta != 0:
+            self._notify()
+
     def reset(self) -> None:
         """Reset  the encoder's value to 0."""
         with self.lock:
             self.value = 0
+            self._samples = 0
+            self._publish(self.value, True)
             LOG.info("%s = %d (reset)", self.name, self.value)
+        self._notify()
 
-class FakeSensor:
+class FakeSensor(Observable):
     """ Used to fake the sensors around the robot """
 
     def __init__(self, name: str):
-        self.name = name
+        super().__init__(name)
         self.value = 0
+        self.valid = False
         self.lock = threading.Lock()
+        self.interval = DATA_INTERVAL
+
+    def set_interval(self, interval: int) -> int:
+        """ Record the requested interval, as with a `Distance` """
+        previous, self.interval = self.interval, interval
+        return previous
 
     def get(self):
         """ Returns the value of the sensors data """
@@ -239,10 +667,35 @@ class FakeSensor:
             data = self.value
         return data
 
-    def set(self, value):
+    def get_valid(self) -> bool:
+        """ Returns true/false if the sensor reading is valid """
+        with self.lock:
+            return self.valid
+
+    def set(self, value, valid: bool = True):
         """ Set the value of the sensors data """
         with self.lock:
             self.value = value
+            self.valid = valid
+            self._publish(value, valid)
+        self._notify()
+
+    def change(self, delta: int) -> None:
+        """ Increment the sensor's value, as with a `RotaryEncoder` """
+        if delta != 0:
+            with self.lock:
+                self.value += delta
+                self.valid = True
+                self._publish(self.value, True)
+            self._notify()
+
+    def reset(self) -> None:
+        """ Reset the sensor's value to 0 """
+        self.set(0)
+
+    def predict(self, _ahead: float = 0.0) -> float:
+        """ Returns the sensor's value, as with a `RotaryEncoder` """
+        return self.get()
 
     def __enter__(self):
         return self
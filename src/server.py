@@ -1,31 +1,75 @@
 #!/usr/bin/env python3
-"""A basic server for the demo days."""
+"""A basic server for the demo days.
+
+   Flags:
+     -M  Don't control the motors.
+     -S  Use a simulated motor and encoder board, rather than the I2C bus.
+"""
 
 # pylint: disable=W0611
 
 import asyncio
-import inspect
+from collections import OrderedDict
+import json
 import logging
 import signal
 import sys
 import time
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import autonomous_control as control
+import bus
+import instrument
 import log
 import motor
-from data import SensorData
+import protocol
+import sensor
+import telemetry
+from data import PHIDGET_SENSORS, SensorData, SENSORS
 from i2c_sensor_thread import RotaryEncoderThread
+from routine import Supervisor
+from watchdog import Watchdog
 
 NETWORK_LOG = logging.getLogger("Network")
 
+# Where the telemetry buffer is written, when requested with SIGUSR1 or when the
+# server exits abnormally.
+TELEMETRY_FILE = "telemetry.bin"
+
+# Once a client has this many bytes waiting to be sent, we stop writing to it
+# directly and start coalescing its messages, until it drains below the low mark.
+HIGH_WATER = 16 * 1024
+LOW_WATER = 4 * 1024
+
+# The maximum number of messages held for a lagging client. Beyond this, the
+# oldest are dropped.
+MAX_PENDING = 64
+
+# Limits (in updates per second) on how often clients may ask for sensor data.
+MIN_STREAM_RATE = 0.5
+MAX_STREAM_RATE = 20
+DEFAULT_STREAM_RATE = 5
+
+# How long (in seconds) to wait for every Phidget sensor to attach, in total.
+ATTACHMENT_DEADLINE = 2.0
+
+# Sensors we can run without if they fail to attach, as no routine relies on
+# them. Any other missing sensor stops the server from starting.
+OPTIONAL_SENSORS = frozenset(("back_ground_dist", "back_stair_touch"))
+
 class ConnectionManager:
     """Manages a set of connections, with the ability to send messages to all
        connected clients.
 
+       Messages are encoded once and written to every client. Clients which
+       cannot keep up are not written to until they catch up. Instead, we hold
+       onto their most recent message for each key (so a lagging client only
+       receives the latest status, rather than every one it missed).
+
     """
     def __init__(self):
         self.connections = set()
+        self.sent = 0
 
     def add(self, connection):
         """Add a connection to the manager"""
@@ -35,11 +79,25 @@ class ConnectionManager:
         """Remove a connection from the manager"""
         self.connections.remove(connection)
 
-    def send(self, message):
-        """Send a message to all current connections"""
-        message = (message + "\n").encode()
+    def send(self, message, key="status"):
+        """Send a message to all current connections. Messages with the same key
+           replace each other when a client is lagging behind. Use a key of None
+           for messages which should never be replaced.
+        """
+        data = (message + "\n").encode()
+        self.sent += 1
         for connection in self.connections:
-            connection.transport.write(message)
+            connection.write(data, key)
+
+    def stats(self) -> Dict[str, int]:
+        """Get statistics about the messages sent to clients."""
+        return {
+            "connections": len(self.connections),
+            "paused": sum(1 for connection in self.connections if connection.paused),
+            "sent": self.sent,
+            "coalesced": sum(connection.coalesced for connection in self.connections),
+            "dropped": sum(connection.dropped for connection in self.connections),
+        }
 
 class SingleValueQueue:
     """An asyncronous queue which holds a single value. Simply used to push values
@@ -75,14 +133,22 @@ def exception_handler(loop, context):
         loop.stop()
     loop.default_exception_handler(context)
 
-async def motor_control(queue: SingleValueQueue, manager: ConnectionManager, data: SensorData) -> None:
-    """Pulls events from `queue` and executes them on the motors"""
+async def motor_control(queue: SingleValueQueue, manager: ConnectionManager, data: SensorData,
+                        supervisor: Supervisor) -> None:
+    """Pulls events from `queue` and executes them on the motors. Long-running
+       routines are handed to `supervisor`.
+    """
     motor.stop_motors()
 
-    commands = control.__dict__
     motor_log = logging.getLogger("Motor")
+    loop = asyncio.get_event_loop()
     while True:
-        action = (await queue.pull()).lower().replace(' ', '_')
+        message = await queue.pull()
+        requested = loop.time()
+        action = "_".join(message.words)
+
+        # Any new command preempts whatever routine is running.
+        await supervisor.cancel(requested)
         motor.stop_motors()
         await asyncio.sleep(0.005)
 
@@ -92,46 +158,67 @@ async def motor_control(queue: SingleValueQueue, manager: ConnectionManager, dat
             manager.send("Idle")
             data.set_moving(False)
             control.stop()
-        elif action in commands:
-            # If we're a function defined in the control module, execute it.
-            data.set_moving(True)
-            motor_log.info("Running %s", action)
-            manager.send("Running " + action)
-            command = commands[action]
-
-            # Prepare call for this command
-            params = inspect.signature(command).parameters
-            args = {} # type: Dict[str, Any]
-            if "data" in params:
-                args["data"] = data
-            if "callback" in params:
-                args["callback"] = manager.send
-
-            command(**args)
-        else:
+            continue
+
+        command, args = control.find_command(message.words)
+        if command is None:
             manager.send("Doing goodness knows what.")
+            continue
+
+        try:
+            run = command.bind(args, data, manager.send)
+        except control.CommandError as error:
+            manager.send(str(error))
+            continue
+
+        data.set_moving(True)
+        motor_log.info("Running %s", command.name)
+        if command.routine:
+            await supervisor.start(command.name, run(), requested)
+        else:
+            manager.send("Running " + command.name)
+            run()
 
 class SpencerServerConnection(asyncio.Protocol):
     """Represents a socket connection to a "spencer client". Namely, a phone running
        the spencer app.
 
        This simply registers itself in the connection manager, and assumes all
-       incomming messages are motor controls.
+       incomming messages are motor controls, apart from "subscribe [rate]",
+       "unsubscribe", "commands" (which lists the available commands and
+       their arguments, as JSON) and "stats" (which sends the timings of the
+       current or last routine, see `instrument`, and how often each sensor
+       is sending readings).
+
+       Subscribing streams sensor readings to this client, as lines of JSON
+       such as `{"t": 12.5, "sensors": {"front_dist_0": 10.2}}`. Only sensors
+       which have changed since the last line are included, and invalid
+       readings are sent as null.
 
     """
 
-    def __init__(self, queue, manager):
+    def __init__(self, queue, manager, data=None):
         self.queue = queue
         self.manager = manager
+        self.data = data
+        self.stream = None # type: Optional[asyncio.Future[None]]
 
         self.peername = None
         self.transport = None
-        self.buffer = ""
+        self.parser = protocol.FrameParser()
         self.count = 0
 
+        # Messages waiting to be written while the transport's buffer is full,
+        # keyed so newer messages can replace older ones.
+        self.paused = False
+        self.pending = OrderedDict() # type: OrderedDict[Any, bytes]
+        self.coalesced = 0
+        self.dropped = 0
+
     def connection_made(self, transport):
         self.peername = transport.get_extra_info('peername')
         self.transport = transport
+        transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
 
         NETWORK_LOG.info('Connection from %s', self.peername)
         self.manager.add(self)
@@ -139,29 +226,126 @@ class SpencerServerConnection(asyncio.Protocol):
     def connection_lost(self, exc):
         NETWORK_LOG.info('Lost connection from %s (%s)', self.peername, exc)
         self.manager.remove(self)
-        self.queue.push("stop")
+        self.unsubscribe()
+        self.queue.push(protocol.parse("stop"))
+
+    def subscribe(self, rate):
+        """Start streaming sensor data to this client, `rate` times a second."""
+        self.unsubscribe()
+        rate = max(MIN_STREAM_RATE, min(MAX_STREAM_RATE, rate))
+        NETWORK_LOG.info('Streaming sensors to %s at %.1fHz', self.peername, rate)
+        self.stream = asyncio.ensure_future(self._stream(1 / rate))
+
+    def unsubscribe(self):
+        """Stop streaming sensor data to this client."""
+        if self.stream is not None:
+            self.stream.cancel()
+            self.stream = None
+
+    async def _stream(self, interval):
+        """Send changed sensor values every `interval` seconds."""
+        last = {} # type: Dict[str, Any]
+        while True:
+            # If the client can't keep up, skip this update. As we only mark
+            # values as sent once they've been written, the next update will
+            # include everything the client missed.
+            if not self.paused:
+                snapshot = self.data.snapshot()
+                changed = {}
+                for name in SENSORS:
+                    value = getattr(snapshot, name) if snapshot.valid(name) else None
+                    if isinstance(value, float):
+                        value = round(value, 2)
+                    if name not in last or last[name] != value:
+                        changed[name] = last[name] = value
+
+                if changed:
+                    self.write((json.dumps({"t": round(snapshot.time, 3), "sensors": changed}) + "\n").encode())
+
+            await asyncio.sleep(interval)
+
+    def handle_message(self, message: protocol.Message) -> bool:
+        """Handle any messages for this connection, rather than the motors.
+           Returns True if the message was handled.
+        """
+        if message.command == "subscribe" and self.data is not None:
+            try:
+                self.subscribe(float(message.args[0]) if message.args else DEFAULT_STREAM_RATE)
+            except ValueError:
+                self.send("Cannot subscribe at rate %s" % message.args[0])
+            return True
+        if message.words == ("unsubscribe",):
+            self.unsubscribe()
+            return True
+        if message.words == ("stats",):
+            self.send(json.dumps({
+                "summary": instrument.summary(),
+                "sensors": self.data.stats() if self.data is not None else None,
+            }))
+            return True
+        if message.words == ("commands",):
+            self.send(json.dumps({"commands": {
+                name: [param.name for param in command.params]
+                for name, command in control.COMMANDS.items()
+            }}))
+            return True
+        return False
 
     def data_received(self, data):
-        # Messages are terminated by a new line, so add to our existing buffer
-        # an split on \n. Any non-terminated data will be stored back in
-        # `self.buffer` again.
-        messages = (self.buffer + data.decode()).split("\n")
-        self.buffer = messages.pop()
-        # I'm going to confess, the above code is horrible. It works though!
-        for message in messages:
+        for message in self.parser.feed(data):
             self.count += 1
 
-            # Delete trailing \r if we're commanding it via telnet (goodness, I
-            # hope not)
-            if message.endswith("\r"):
-                message = message[:-1]
+            NETWORK_LOG.debug('Message received: %s', message.text)
+            if not self.handle_message(message):
+                self.queue.push(message)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        while self.pending and not self.paused:
+            _, data = self.pending.popitem(last=False)
+            self.transport.write(data)
+
+    def write(self, data, key=None):
+        """Write some encoded `data` to the client, or queue it if the client is
+           lagging behind. See `ConnectionManager.send`.
+        """
+        if not self.paused:
+            self.transport.write(data)
+            return
 
-            NETWORK_LOG.debug('Message received: %s', message)
-            self.queue.push(message)
+        if key is None:
+            key = object()
+        elif key in self.pending:
+            self.coalesced += 1
+            del self.pending[key]
 
-    def send(self, message):
+        self.pending[key] = data
+        if len(self.pending) > MAX_PENDING:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+    def send(self, message, key=None):
         """Send a `message` to the connected client."""
-        self.transport.write((message + "\n").encode())
+        self.write((message + "\n").encode(), key)
+
+def attach_sensors(data: SensorData) -> Dict[str, Optional[float]]:
+    """Attach every Phidget sensor at once, returning how long each took. This
+       raises an IOError if any sensor not in `OPTIONAL_SENSORS` is missing.
+    """
+    sensors = [getattr(data, name) for name in PHIDGET_SENSORS]
+    attached = sensor.attach(sensors, ATTACHMENT_DEADLINE)
+
+    missing = [name for name, took in attached.items() if took is None]
+    required = [name for name in missing if name not in OPTIONAL_SENSORS]
+    if required:
+        raise IOError("Sensors did not attach: " + ", ".join(required))
+    if missing:
+        logging.warning("Running without sensors: %s", ", ".join(missing))
+
+    return attached
 
 async def check_sensors(data: SensorData) -> None:
     """Monitors the two distance sensors for 2 seconds, and errors if they
@@ -177,78 +361,122 @@ async def check_sensors(data: SensorData) -> None:
 
     raise IOError("Sensor data is still invalid after 2 seconds.")
 
-def cleanup() -> None:
-    """Close all tasks currently running"""
-    for task in asyncio.Task.all_tasks():
+def cleanup(loop: asyncio.AbstractEventLoop) -> None:
+    """Cancel all tasks currently running, and wait for them to finish."""
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
         task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+def dump_telemetry() -> None:
+    """Write the telemetry buffer to `TELEMETRY_FILE`."""
+    count = telemetry.dump(TELEMETRY_FILE)
+    logging.info("Wrote %d telemetry events to %s", count, TELEMETRY_FILE)
 
 def _main():
     """The main entry point of the server"""
 
     log.configure()
 
+    if "-S" in sys.argv:
+        bus.use(bus.SimulatedBackend())
+    scheduler = bus.start()
+
     control.stop()
 
     # Create an event loop. This effectively allows us to run multiple functions
     # at once (namely, the motor controller and server).
     loop = asyncio.get_event_loop()
     loop.set_exception_handler(exception_handler)
+    loop.add_signal_handler(signal.SIGUSR1, dump_telemetry)
 
     # Motor control statements are pushed into this queue
     motor_queue = SingleValueQueue()
 
     # And we hold all currently connected computers here
     manager = ConnectionManager()
+    supervisor = Supervisor(manager.send)
 
     # Grab our sensor data
     data = SensorData()
 
+    # Brake the motors if the loop stalls.
+    watchdog = None # type: Optional[Watchdog]
     if "-M" not in sys.argv:
-        loop.create_task(motor_control(motor_queue, manager, data))
+        loop.create_task(motor_control(motor_queue, manager, data, supervisor))
+        watchdog = Watchdog(control.brake, control.SLEEP)
+        loop.create_task(watchdog.heartbeat())
 
     # Create the sensor thread
-    thread_i2c_sensors = RotaryEncoderThread(1, 5, data)
+    thread_i2c_sensors = RotaryEncoderThread(data)
     thread_i2c_sensors.setDaemon(5)
     thread_i2c_sensors.start()
 
     # Construct the server and run it forever
     server = None
+    # How long each stage of starting up took, in seconds.
+    startup = OrderedDict() # type: Dict[str, float]
+    started = time.monotonic()
     try:
-        with data.front_dist_0, \
-             data.front_dist_1, \
-             data.front_ground_dist, \
-             data.back_ground_dist, \
-             data.front_ground_touch, \
-             data.middle_stair_touch, \
-             data.back_stair_touch, \
-             data.back_ground_touch, \
-             data.middle_ground_touch:
-
-            # Reset the front and back to clear any residual data
-            server = loop.run_until_complete(loop.create_server(
-                lambda: SpencerServerConnection(motor_queue, manager),
-                '0.0.0.0', 1050
-            ))
-
-            NETWORK_LOG.info('Serving on %s', server.sockets[0].getsockname())
-
-            # Wait for 2 seconds to ensure the server is ready
-            loop.run_until_complete(check_sensors(data))
-
-            # Zero the motors
-            loop.run_until_complete(control.zero(data, manager.send))
-
-            loop.run_forever()
+        attached = attach_sensors(data)
+        startup["attach"] = time.monotonic() - started
+        logging.info("Sensors attached after: %s", ", ".join(
+            "%s %s" % (name, "%.0fms" % (took * 1000) if took is not None else "never")
+            for name, took in attached.items()))
+
+        # Reset the front and back to clear any residual data
+        server = loop.run_until_complete(loop.create_server(
+            lambda: SpencerServerConnection(motor_queue, manager, data),
+            '0.0.0.0', 1050
+        ))
+
+        NETWORK_LOG.info('Serving on %s', server.sockets[0].getsockname())
+
+        if watchdog is not None:
+            watchdog.start()
+
+        # Wait for 2 seconds to ensure the server is ready
+        stage = time.monotonic()
+        loop.run_until_complete(check_sensors(data))
+        startup["check"] = time.monotonic() - stage
+
+        # Zero the motors
+        stage = time.monotonic()
+        loop.run_until_complete(control.zero(data, manager.send))
+        startup["zero"] = time.monotonic() - stage
+
+        logging.info("Started in %.2fs (%s)", time.monotonic() - started,
+                     ", ".join("%s %.2fs" % stage for stage in startup.items()))
+
+        loop.run_forever()
+    except BaseException:
+        dump_telemetry()
+        raise
     finally:
+        if watchdog is not None:
+            watchdog.stop()
+            logging.info("Loop lag: %s", watchdog.stats())
+
         if server is not None:
             server.close()
             loop.run_until_complete(server.wait_closed())
 
+        cleanup(loop)
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
 
+        logging.info("Sensor rates: %s", data.stats())
+        for name in PHIDGET_SENSORS:
+            getattr(data, name).close()
+
+        # Nothing else may touch the bus once it is closed.
+        thread_i2c_sensors.stop()
         if "-M" not in sys.argv:
             motor.float_motors()
+        bus.close()
+        logging.info("Bus: %s", scheduler.stats())
+
+        log.shutdown()
 
 if __name__ == "__main__":
     _main()
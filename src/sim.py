@@ -0,0 +1,586 @@
+"""A kinematic simulation of Spencer climbing a staircase.
+
+   Motor commands sent to the motor board drive simulated wheels and lifting
+   mechanisms, which in turn produce the encoder deltas, touch states and
+   distance readings the real sensors would. The simulation plugs in below the
+   rest of the code as a `bus` backend and fake `Phidget22` modules, so the
+   server and control routines run unmodified.
+
+   `install` must be called before any module which uses the sensors (sensor,
+   data, server, ...) is imported.
+
+   Usage:
+     python sim.py            Run the server against a simulated staircase.
+     python sim.py --batch N  Time N simulated climbs over random staircases.
+       --noise SD               Add noise (and occasional spikes) to the distance
+                                readings, with a standard deviation of SD cm.
+       --lift-rates FRONT,BACK  Move the lifting mechanisms at these rates (in
+                                encoder ticks per second at full power).
+"""
+
+# pylint: disable=invalid-name,import-outside-toplevel,too-many-instance-attributes
+
+import asyncio
+from collections import OrderedDict
+import logging
+import math
+import random
+import sys
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import bus
+
+LOG = logging.getLogger("Sim")
+
+MOTOR_ADDRESS = 0x04
+ENCODER_ADDRESS = 0x05
+
+# Which motors do what. These mirror the constants in autonomous_control, but
+# are repeated here so this module can be imported before it.
+DRIVE_FWD, DRIVE_BACK, STEP_FRONT, STEP_BACK, DRIVE_RIGHT, DRIVE_LEFT = range(6)
+
+# The sensors attached to each Phidget channel, matching SensorData.
+DISTANCE_CHANNELS = ("front_dist_0", "front_dist_1", "front_ground_dist", "back_ground_dist")
+TOUCH_CHANNELS = ("front_ground_touch", "middle_stair_touch", "back_stair_touch",
+                  "back_ground_touch", "middle_ground_touch")
+
+# Physical properties of the robot, in centimetres and seconds.
+DRIVE_SPEED = 20.0 # Forward speed at full power
+LIFT_RATE = 1000.0 # Encoder ticks per second at full power
+TICKS_PER_CM = 60.0 # Encoder ticks per cm of leg extension
+WIDTH = 30.0 # Distance between the two front distance sensors
+MIDDLE = 15.0 # Distance from the front foot to the middle of the body
+LENGTH = 30.0 # Distance from the front foot to the back foot
+SENSOR_HEIGHT = 3.0 # Height of the front distance sensors above the body
+GROUND_SENSOR_HEIGHT = 4.0 # Height of the ground distance sensors above the body
+FRONT_ROT_RANGE = (-1450, 100)
+BACK_ROT_RANGE = (-150, 1450)
+
+# How close (in cm) something must be to count as touching.
+TOUCH_TOLERANCE = 1.0
+
+# The range the Sharp 2D120X distance sensors can read.
+DISTANCE_RANGE = (4.0, 30.0)
+
+# The chance of a distance reading being a spurious spike, when adding noise.
+SPIKE_RATE = 0.02
+
+# The range of data intervals (in ms) the Phidget interface board supports.
+MIN_DATA_INTERVAL = 1
+MAX_DATA_INTERVAL = 60000
+
+# The Phidget error code for a sensor reading out of range.
+ERROR_OUT_OF_RANGE = 4103
+
+# How often the plant is stepped.
+STEP = 0.005
+
+class Staircase(NamedTuple("Staircase", [("steps", int), ("rise", float), ("tread", float),
+                                         ("start", float), ("angle", float)])):
+    """A flight of stairs. The robot starts `start` cm from the bottom riser,
+       turned `angle` radians away from facing it square on.
+    """
+
+    def height(self, x: float) -> float:
+        """The height of the ground at a distance `x` along the stairs."""
+        if x < self.start:
+            return 0.0
+        return min(self.steps, int((x - self.start) // self.tread) + 1) * self.rise
+
+    def next_riser(self, x: float, height: float) -> Optional[float]:
+        """Find the position of the first riser after `x` which is taller than
+           `height`, if any.
+        """
+        for step in range(self.steps):
+            riser = self.start + step * self.tread
+            if riser > x and (step + 1) * self.rise > height:
+                return riser
+        return None
+
+DEFAULT_STAIRS = Staircase(steps=3, rise=15.0, tread=28.0, start=20.0, angle=0.1)
+
+class Plant:
+    """The simulated robot and staircase."""
+
+    def __init__(self, stairs: Staircase = DEFAULT_STAIRS, noise: float = 0.0, seed: int = 0,
+                 lift_rates: Tuple[float, float] = (LIFT_RATE, LIFT_RATE)) -> None:
+        self.stairs = stairs
+        self.lock = threading.RLock()
+        self.time = 0.0
+
+        # The standard deviation (in cm) of the distance sensors' noise.
+        self.noise = noise
+        self.rng = random.Random(seed)
+
+        # The commanded speed of each motor, from -255 to 255.
+        self.speeds = [0] * 6
+
+        # How fast the front and back lifting mechanisms move at full power.
+        # The real ones differ a little, depending on the load on each.
+        self.lift_rates = lift_rates
+
+        # Position of the front foot along the stairs, and heading (0 is square on)
+        self.x = 0.0
+        self.heading = stairs.angle
+
+        # Absolute and not-yet-read encoder positions
+        self.front_rot = 0.0
+        self.back_rot = 0.0
+        self.front_unread = 0.0
+        self.back_unread = 0.0
+
+        # Heights of the front and back of the body.
+        self.front_height = 0.0
+        self.back_height = 0.0
+
+        self.devices = [] # type: List[_FakePhidget]
+        self._settle()
+        self.readings = self.sensors()
+
+    def command(self, data: List[int]) -> None:
+        """Apply a command written to the motor board."""
+        with self.lock:
+            if data[0] & 1:
+                self.speeds = [0] * 6
+                return
+
+            motor_id, mode = data[0] >> 5, (data[0] >> 1) & 3
+            speed = data[1] if len(data) > 1 else 0
+            if mode == 2:
+                self.speeds[motor_id] = speed
+            elif mode == 3:
+                self.speeds[motor_id] = -speed
+            else:
+                self.speeds[motor_id] = 0
+
+    def read_encoders(self) -> List[int]:
+        """Read the encoder deltas since the last read, as the encoder board
+           reports them: back then front, as signed bytes.
+        """
+        with self.lock:
+            back = max(-128, min(127, int(self.back_unread)))
+            front = max(-128, min(127, int(self.front_unread)))
+            self.back_unread -= back
+            self.front_unread -= front
+        return [back & 0xFF, front & 0xFF]
+
+    def front_extension(self) -> float:
+        """How far the front foot is below the body, in cm."""
+        return self.front_rot / TICKS_PER_CM
+
+    def back_extension(self) -> float:
+        """How far the back foot is below the body, in cm."""
+        return self.back_rot / TICKS_PER_CM
+
+    def _settle(self) -> None:
+        """Let the body come to rest on whichever supports hold it up."""
+        ground = self.stairs.height
+        front = ground(self.x) + self.front_extension()
+        back = ground(self.x - LENGTH) + self.back_extension()
+        middle = ground(self.x - MIDDLE)
+
+        if (front + back) / 2 >= middle:
+            # Resting on both feet
+            self.front_height, self.back_height = front, back
+        else:
+            # Resting on the middle of the body, tipping towards a foot if it
+            # holds that end up.
+            tilt = max(front - middle, min(0.0, middle - back))
+            self.front_height, self.back_height = middle + tilt, middle - tilt
+
+    def _blocked(self, x: float) -> bool:
+        """Whether any part of the robot would hit a step at position `x`."""
+        ground = self.stairs.height
+        middle_height = (self.front_height + self.back_height) / 2
+        return (ground(x) > self.front_height - self.front_extension() + TOUCH_TOLERANCE or
+                ground(x - MIDDLE) > middle_height + TOUCH_TOLERANCE or
+                ground(x - LENGTH) > self.back_height - self.back_extension() + TOUCH_TOLERANCE)
+
+    def step(self, dt: float) -> None:
+        """Advance the simulation by `dt` seconds."""
+        with self.lock:
+            self.time += dt
+
+            # Lifting mechanisms
+            front_delta = self.speeds[STEP_FRONT] / 255 * self.lift_rates[0] * dt
+            front_rot = max(FRONT_ROT_RANGE[0], min(FRONT_ROT_RANGE[1], self.front_rot + front_delta))
+            self.front_unread += front_rot - self.front_rot
+            self.front_rot = front_rot
+
+            back_delta = self.speeds[STEP_BACK] / 255 * self.lift_rates[1] * dt
+            back_rot = max(BACK_ROT_RANGE[0], min(BACK_ROT_RANGE[1], self.back_rot + back_delta))
+            self.back_unread += back_rot - self.back_rot
+            self.back_rot = back_rot
+
+            # Drive wheels. The left motor (and the middle ones) are mounted
+            # backwards, so negative speeds drive forwards.
+            left = -self.speeds[DRIVE_LEFT] / 255 * DRIVE_SPEED
+            right = self.speeds[DRIVE_RIGHT] / 255 * DRIVE_SPEED
+            middle = -(self.speeds[DRIVE_FWD] + self.speeds[DRIVE_BACK]) / 2 / 255 * DRIVE_SPEED
+
+            self.heading += (right - left) / WIDTH * dt
+            x = self.x + (left + right + 2 * middle) / 4 * math.cos(self.heading) * dt
+            if not self._blocked(x):
+                self.x = x
+
+            self._settle()
+            self.readings = self.sensors()
+
+        for device in self.devices:
+            device.update(self.time)
+
+    def sensors(self) -> Dict[str, Optional[float]]:
+        """Compute what each Phidget sensor currently reads. Distances are None if
+           out of range, touch sensors are 1 or 0.
+        """
+        with self.lock:
+            ground = self.stairs.height
+            middle_height = (self.front_height + self.back_height) / 2
+
+            def distance(value: Optional[float]) -> Optional[float]:
+                if value is None or not DISTANCE_RANGE[0] <= value <= DISTANCE_RANGE[1]:
+                    return None
+                return value
+
+            # The front sensors see the next riser taller than them. Sensor 1
+            # sits on the side of the right drive motor.
+            riser = self.stairs.next_riser(self.x, self.front_height + SENSOR_HEIGHT)
+            offset = WIDTH / 2 * math.sin(self.heading)
+            front_0 = None if riser is None else riser - self.x + offset
+            front_1 = None if riser is None else riser - self.x - offset
+
+            return {
+                "front_dist_0": distance(front_0),
+                "front_dist_1": distance(front_1),
+                "front_ground_dist": distance(self.front_height + GROUND_SENSOR_HEIGHT - ground(self.x + 2)),
+                "back_ground_dist": distance(self.back_height + GROUND_SENSOR_HEIGHT - ground(self.x - LENGTH - 2)),
+
+                "front_ground_touch":
+                    int(self.front_height - self.front_extension() - ground(self.x) <= TOUCH_TOLERANCE),
+                "middle_stair_touch": int(ground(self.x - MIDDLE + 0.5) > middle_height + TOUCH_TOLERANCE),
+                "back_stair_touch": int(ground(self.x - LENGTH - 0.5) > self.back_height + TOUCH_TOLERANCE),
+                "back_ground_touch":
+                    int(self.back_height - self.back_extension() - ground(self.x - LENGTH) <= TOUCH_TOLERANCE),
+                "middle_ground_touch": int(middle_height - ground(self.x - MIDDLE) <= TOUCH_TOLERANCE),
+            }
+
+    def measure(self, distance: float) -> float:
+        """Add noise to a distance reading, as the real sensors would."""
+        if not self.noise:
+            return distance
+        if self.rng.random() < SPIKE_RATE:
+            return self.rng.uniform(*DISTANCE_RANGE)
+        return min(DISTANCE_RANGE[1], max(DISTANCE_RANGE[0], self.rng.gauss(distance, self.noise)))
+
+    def steps_climbed(self) -> int:
+        """The step the middle of the robot is currently on."""
+        with self.lock:
+            return int(round(self.stairs.height(self.x - MIDDLE) / self.stairs.rise))
+
+# The plant which fake devices currently talk to.
+PLANT = None # type: Optional[Plant]
+
+def _plant() -> Plant:
+    if PLANT is None:
+        raise RuntimeError("No simulation installed")
+    return PLANT
+
+class PlantBackend(bus.Backend):
+    """A bus backend talking to the simulated motor board and encoders."""
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        if address != MOTOR_ADDRESS:
+            raise IOError("No device at address %d" % address)
+        for block in blocks:
+            _plant().command(list(block))
+
+    def read(self, address: int, length: int) -> List[int]:
+        if address != ENCODER_ADDRESS:
+            raise IOError("No device at address %d" % address)
+        return _plant().read_encoders()[:length]
+
+class _FakePhidget:
+    """The parts of the Phidget22 channel API which our sensors use."""
+    def __init__(self) -> None:
+        self.channel = 0
+        self.interval = 8
+        self.next_update = 0.0
+        self.on_error = None # type: Optional[Callable[..., None]]
+        self.on_attach = None # type: Optional[Callable[..., None]]
+        self.attached = False
+
+    def setChannel(self, channel: int) -> None:
+        """Set the channel to open."""
+        self.channel = channel
+
+    def getChannel(self) -> int:
+        """Get the channel."""
+        return self.channel
+
+    def getChannelClassName(self) -> str:
+        """Get the name of this channel class."""
+        return type(self).__name__
+
+    def setOnErrorHandler(self, handler: Optional[Callable[..., None]]) -> None:
+        """Set the error callback."""
+        self.on_error = handler
+
+    def setDataInterval(self, interval: int) -> None:
+        """Set how often (in ms) readings are sent."""
+        self.interval = interval
+
+    def getDataInterval(self) -> int:
+        """Get how often (in ms) readings are sent."""
+        return self.interval
+
+    def getMinDataInterval(self) -> int:
+        """Get the shortest interval the device supports."""
+        return MIN_DATA_INTERVAL
+
+    def getMaxDataInterval(self) -> int:
+        """Get the longest interval the device supports."""
+        return MAX_DATA_INTERVAL
+
+    def setOnAttachHandler(self, handler: Optional[Callable[..., None]]) -> None:
+        """Set the callback for the sensor attaching."""
+        self.on_attach = handler
+
+    def open(self) -> None:
+        """Attach to the simulated sensor."""
+        self.attached = True
+        if self.on_attach is not None:
+            self.on_attach(self)
+        _plant().devices.append(self)
+        self.update(_plant().time)
+
+    def close(self) -> None:
+        """Detach from the simulated sensor."""
+        self.attached = False
+        if PLANT is not None and self in PLANT.devices:
+            PLANT.devices.remove(self)
+
+    def update(self, now: float) -> None:
+        """Send any readings which are due."""
+        raise NotImplementedError()
+
+class _Unit:
+    symbol = "cm"
+
+class FakeVoltageRatioInput(_FakePhidget):
+    """A simulated Sharp IR distance sensor."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.on_change = None # type: Optional[Callable[..., None]]
+        self.last = None # type: Optional[float]
+        self.in_range = True
+        self.trigger = None # type: Optional[float]
+
+    def setOnSensorChangeHandler(self, handler: Optional[Callable[..., None]]) -> None:
+        """Set the callback for new readings."""
+        self.on_change = handler
+
+    def setSensorType(self, _sensor_type: int) -> None:
+        """Set the type of sensor attached."""
+
+    def setSensorValueChangeTrigger(self, trigger: float) -> None:
+        """Set how much a reading must change by to be sent. If 0, every reading is."""
+        self.trigger = trigger
+
+    def update(self, now: float) -> None:
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval / 1000
+
+        value = _plant().readings[DISTANCE_CHANNELS[self.channel]]
+        if value is None:
+            if self.in_range and self.on_error is not None:
+                self.on_error(self, ERROR_OUT_OF_RANGE, "Sensor value is out of range")
+            self.in_range = False
+        elif value != self.last or not self.in_range or self.trigger == 0:
+            self.in_range = True
+            self.last = value
+            if self.on_change is not None:
+                self.on_change(self, _plant().measure(value), _Unit)
+
+class FakeDigitalInput(_FakePhidget):
+    """A simulated touch sensor."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.on_change = None # type: Optional[Callable[..., None]]
+        self.state = None # type: Optional[int]
+
+    def setOnStateChangeHandler(self, handler: Optional[Callable[..., None]]) -> None:
+        """Set the callback for state changes."""
+        self.on_change = handler
+
+    def update(self, now: float) -> None:
+        state = _plant().readings[TOUCH_CHANNELS[self.channel]]
+        if state != self.state:
+            self.state = state
+            if self.on_change is not None:
+                self.on_change(self, state)
+
+def _module(name: str, **attrs: Any) -> types.ModuleType:
+    module = types.ModuleType(name)
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    return module
+
+def install(plant: Plant) -> None:
+    """Make `plant` the current simulation, using it as the bus backend and
+       replacing the Phidget22 modules with ones which talk to it.
+    """
+    global PLANT # pylint: disable=global-statement
+    PLANT = plant
+    bus.use(PlantBackend())
+
+    module = sys.modules.get("Phidget22.Devices.DigitalInput")
+    if getattr(module, "DigitalInput", None) is FakeDigitalInput:
+        return
+
+    for name in ("sensor", "data", "i2c_sensor_thread", "server"):
+        if name in sys.modules:
+            raise RuntimeError("sim.install must be called before %s is imported" % name)
+
+    _module("Phidget22")
+    _module("Phidget22.Devices")
+    _module("Phidget22.Devices.VoltageRatioInput", VoltageRatioInput=FakeVoltageRatioInput,
+            VoltageRatioSensorType=types.SimpleNamespace(SENSOR_TYPE_1101_SHARP_2D120X=0x2B1A))
+    _module("Phidget22.Devices.DigitalInput", DigitalInput=FakeDigitalInput)
+
+def run_realtime(plant: Plant) -> None:
+    """Step `plant` in real time on a background thread, as the hardware would."""
+    def run() -> None:
+        last = time.monotonic()
+        while True:
+            time.sleep(STEP)
+            now = time.monotonic()
+            plant.step(now - last)
+            last = now
+
+    thread = threading.Thread(target=run, name="Simulation", daemon=True)
+    thread.start()
+
+class ClimbResult(NamedTuple("ClimbResult", [("stairs", Staircase), ("duration", float), ("finished", bool),
+                                             ("steps_climbed", int), ("timings", Dict[str, Any])])):
+    """The result of a simulated climb. `timings` is the routine's
+       `instrument.Run` summary.
+    """
+
+def simulate(stairs: Staircase = DEFAULT_STAIRS, routine: str = "climb_", timeout: float = 300,
+             noise: float = 0.0, lift_rates: Tuple[float, float] = (LIFT_RATE, LIFT_RATE)) -> ClimbResult:
+    """Run a control routine against a simulated staircase on a virtual clock.
+       This zeros the motors (as the server does on startup) and then times the
+       routine, much like `autonomous_control.timed`.
+    """
+    plant = Plant(stairs, noise, lift_rates=lift_rates)
+    install(plant)
+
+    import autonomous_control as control
+    import instrument
+    from data import SensorData
+    from i2c_sensor_thread import RotaryEncoderThread
+    from replay import VirtualEventLoop, _reset_control
+
+    loop = VirtualEventLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        _reset_control()
+        data = SensorData()
+        sensors = [getattr(data, name) for name in DISTANCE_CHANNELS + TOUCH_CHANNELS]
+        for sensor in sensors:
+            sensor.__enter__()
+
+        encoders = RotaryEncoderThread(data, ENCODER_ADDRESS)
+        data.front_lifting_rot.clock = loop.time
+        data.back_lifting_rot.clock = loop.time
+
+        def tick() -> None:
+            plant.step(STEP)
+            loop.call_later(STEP, tick)
+
+        def poll() -> None:
+            moved = encoders.poll()
+            loop.call_later(encoders.next_interval(moved, loop.time()), poll)
+
+        loop.call_soon(tick)
+        loop.call_soon(poll)
+
+        instrumented = instrument.Run(routine, clock=loop.time)
+
+        async def run() -> Tuple[float, bool]:
+            await control.zero(data, lambda _: None)
+            data.set_moving(True)
+            start = loop.time()
+            try:
+                with instrumented:
+                    await asyncio.wait_for(getattr(control, routine)(data, lambda _: None)(), timeout)
+                return loop.time() - start, True
+            except asyncio.TimeoutError:
+                return loop.time() - start, False
+
+        duration, finished = loop.run_until_complete(run())
+        for sensor in sensors:
+            sensor.__exit__(None, None, None)
+        return ClimbResult(stairs, duration, finished, plant.steps_climbed(), instrumented.summary())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def random_staircase(rng: random.Random) -> Staircase:
+    """Generate a plausible staircase."""
+    return Staircase(steps=rng.randint(1, 5), rise=rng.uniform(10, 18), tread=rng.uniform(24, 35),
+                     start=rng.uniform(8, 18), angle=rng.uniform(-0.3, 0.3))
+
+def _main() -> None:
+    if "--batch" in sys.argv:
+        logging.basicConfig(level=logging.WARNING)
+        count = int(sys.argv[sys.argv.index("--batch") + 1])
+        noise = float(sys.argv[sys.argv.index("--noise") + 1]) if "--noise" in sys.argv else 0.0
+        lift_rates = (LIFT_RATE, LIFT_RATE)
+        if "--lift-rates" in sys.argv:
+            front, back = sys.argv[sys.argv.index("--lift-rates") + 1].split(",")
+            lift_rates = (float(front), float(back))
+        rng = random.Random(0)
+        start = time.time()
+        results = [simulate(random_staircase(rng), noise=noise, lift_rates=lift_rates) for _ in range(count)]
+        climbed = [result for result in results
+                   if result.finished and result.steps_climbed == result.stairs.steps]
+        for result in results:
+            stairs = result.stairs
+            print("%d steps (rise %4.1f, tread %4.1f, start %4.1f, angle %5.2f): climbed %d in %6.2fs%s" % (
+                stairs.steps, stairs.rise, stairs.tread, stairs.start, stairs.angle,
+                result.steps_climbed, result.duration, "" if result.finished else " (timed out)"))
+
+        print("Climbed %d/%d staircases, simulated in %.2fs" % (len(climbed), count, time.time() - start))
+        if climbed:
+            print("Mean time per step %.2fs" % (
+                sum(result.duration / result.stairs.steps for result in climbed) / len(climbed)))
+
+            # Where the time goes, per step climbed.
+            steps = sum(result.stairs.steps for result in climbed)
+            phases = OrderedDict() # type: Dict[str, List[float]]
+            for result in climbed:
+                for name, phase in result.timings["phases"].items():
+                    totals = phases.setdefault(name, [0.0, 0, 0])
+                    totals[0] += phase["duration"]
+                    totals[1] += phase["commands"]
+                    totals[2] += phase["intervals"]["count"]
+            for name, (duration, commands, iterations) in phases.items():
+                print("  %-20s %6.2fs %6.1f commands %6.1f iterations per step" % (
+                    name, duration / steps, commands / steps, iterations / steps))
+        return
+
+    plant = Plant()
+    install(plant)
+    run_realtime(plant)
+
+    import server
+    server._main() # pylint: disable=protected-access
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,149 @@
+"""A fixed-size, in-memory recording of sensor and motor events.
+
+   Every sensor reading and motor command is appended to a preallocated ring
+   buffer, which is cheap enough to write from the sensor callbacks. The buffer
+   can be dumped to a binary file on demand (or when the server crashes) and
+   loaded again for analysis.
+"""
+
+from array import array
+import mmap
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+# The number of events we hold before overwriting the oldest ones. At 20Hz for
+# each sensor, this is a little over five minutes of data.
+CAPACITY = 1 << 16
+
+MAGIC = b"SPTL"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+
+Columns = Tuple[List[str], "array[float]", "array[int]", "array[float]"]
+
+class Telemetry:
+    """A ring buffer of (timestamp, channel, value) events."""
+
+    def __init__(self, capacity: int = CAPACITY) -> None:
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.channels = array('H', bytes(2 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+
+        # The total number of events ever recorded. The next event is written
+        # at `count % capacity`.
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.names = [] # type: List[str]
+        self._ids = {} # type: Dict[str, int]
+
+    def channel(self, name: str) -> int:
+        """Get the id of the channel with the given name, registering it if needed."""
+        with self.lock:
+            channel = self._ids.get(name)
+            if channel is None:
+                channel = len(self.names)
+                self.names.append(name)
+                self._ids[name] = channel
+            return channel
+
+    def record(self, channel: int, value: float) -> None:
+        """Append an event to the buffer, overwriting the oldest one if full."""
+        now = time.time()
+        with self.lock:
+            index = self.count % self.capacity
+            self.times[index] = now
+            self.channels[index] = channel
+            self.values[index] = value
+            self.count += 1
+
+    def columns(self) -> Columns:
+        """Copy the recorded events, oldest first, as separate columns."""
+        with self.lock:
+            if self.count <= self.capacity:
+                end = self.count
+                return (list(self.names), self.times[:end], self.channels[:end], self.values[:end])
+
+            start = self.count % self.capacity
+            return (list(self.names),
+                    self.times[start:] + self.times[:start],
+                    self.channels[start:] + self.channels[:start],
+                    self.values[start:] + self.values[:start])
+
+    def entries(self) -> Iterator[Tuple[float, str, float]]:
+        """Iterate over all recorded events, oldest first."""
+        names, times, channels, values = self.columns()
+        for i, timestamp in enumerate(times):
+            yield timestamp, names[channels[i]], values[i]
+
+    def dump(self, path: str) -> int:
+        """Write the recorded events to a binary file. Returns the number of events
+           written.
+
+           The file consists of a header, the channel names (each prefixed with its
+           length) and then the times, channels and values columns.
+        """
+        names, times, channels, values = self.columns()
+        encoded = [name.encode() for name in names]
+        count = len(times)
+
+        size = (HEADER.size + sum(1 + len(name) for name in encoded) +
+                times.itemsize * count + channels.itemsize * count + values.itemsize * count)
+
+        with open(path, "w+b") as handle:
+            handle.truncate(size)
+            with mmap.mmap(handle.fileno(), size) as out:
+                HEADER.pack_into(out, 0, MAGIC, VERSION, len(encoded), count)
+                offset = HEADER.size
+                for name in encoded:
+                    out[offset] = len(name)
+                    out[offset + 1:offset + 1 + len(name)] = name
+                    offset += 1 + len(name)
+
+                for column in (times, channels, values):
+                    data = column.tobytes()
+                    out[offset:offset + len(data)] = data
+                    offset += len(data)
+
+        return count
+
+def load(path: str) -> Columns:
+    """Load events written by `Telemetry.dump`."""
+    with open(path, "rb") as handle:
+        contents = handle.read()
+
+    magic, version, channel_count, count = HEADER.unpack_from(contents, 0)
+    if magic != MAGIC or version != VERSION:
+        raise IOError("%s is not a telemetry file" % path)
+
+    offset = HEADER.size
+    names = []
+    for _ in range(channel_count):
+        length = contents[offset]
+        names.append(contents[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+
+    times, channels, values = array('d'), array('H'), array('d')
+    for column in (times, channels, values):
+        length = column.itemsize * count
+        column.frombytes(contents[offset:offset + length])
+        offset += length
+
+    return names, times, channels, values
+
+TELEMETRY = Telemetry()
+
+def channel(name: str) -> int:
+    """Register a channel on the global telemetry buffer."""
+    return TELEMETRY.channel(name)
+
+def record(channel_id: int, value: float) -> None:
+    """Record an event on the global telemetry buffer."""
+    TELEMETRY.record(channel_id, value)
+
+def dump(path: str) -> int:
+    """Dump the global telemetry buffer to a file."""
+    return TELEMETRY.dump(path)
@@ -0,0 +1,109 @@
+"""A deadman timer for the motors.
+
+   The event loop sends a heartbeat every `HEARTBEAT_INTERVAL` seconds. If a
+   separate thread sees no heartbeat for `DEADLINE` seconds (say the loop is
+   stuck on a blocking write, or swamped by sensor callbacks) it brakes the
+   motors, rather than leaving them running at whatever speed they were last
+   set to.
+
+   The heartbeat also measures how late the loop wakes up, which tells us how
+   often the controller misses its `SLEEP` period.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from instrument import Histogram
+
+LOG = logging.getLogger("Watchdog")
+
+HEARTBEAT_INTERVAL = 0.05
+DEADLINE = 0.5
+
+# Upper bounds (in seconds) of the buckets in the loop lag histogram.
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, float("inf"))
+
+class Watchdog(threading.Thread):
+    """Calls `trip` (which should stop the motors) from its own thread if the
+       event loop stops sending heartbeats.
+
+       `period` is the controller's polling period; heartbeats which are later
+       than this are counted as misses.
+    """
+
+    def __init__(self, trip: Callable[[], None], period: float,
+                 deadline: float = DEADLINE, interval: float = HEARTBEAT_INTERVAL) -> None:
+        super().__init__(name="Watchdog", daemon=True)
+        self.trip = trip
+        self.period = period
+        self.deadline = deadline
+        self.interval = interval
+
+        self.last = time.monotonic()
+        self.stopped = threading.Event()
+        self.tripped = False
+        self.trips = 0
+
+        # Loop lag statistics, only touched by the event loop.
+        self.misses = 0
+        self.lag = Histogram(LAG_BUCKETS)
+
+    def beat(self) -> None:
+        """Tell the watchdog the loop is still alive."""
+        self.last = time.monotonic()
+
+    def start(self) -> None:
+        self.beat()
+        super().start()
+
+    def stop(self) -> None:
+        """Stop watching the loop."""
+        self.stopped.set()
+
+    def run(self) -> None:
+        try:
+            # Ask to be scheduled ahead of everything else. This needs to run as
+            # root, so we carry on regardless if it fails.
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+        except (AttributeError, OSError):
+            LOG.debug("Cannot raise watchdog priority")
+
+        check = min(self.interval, self.deadline / 4)
+        while not self.stopped.wait(check):
+            age = time.monotonic() - self.last
+            if age > self.deadline:
+                if not self.tripped:
+                    self.tripped = True
+                    self.trips += 1
+                    LOG.error("No heartbeat for %.0fms, stopping motors", age * 1000)
+                    self.trip()
+            elif self.tripped:
+                self.tripped = False
+                LOG.warning("Heartbeat resumed")
+
+    async def heartbeat(self) -> None:
+        """Send heartbeats from the event loop, recording how late each one is."""
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.beat()
+
+            lag = max(0.0, loop.time() - expected)
+            self.lag.add(lag)
+            if lag > self.period:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics on how late the loop has been running."""
+        return {
+            "beats": self.lag.count,
+            "misses": self.misses,
+            "miss_rate": self.misses / self.lag.count if self.lag.count else 0.0,
+            "lag": self.lag.stats(),
+            "trips": self.trips,
+        }
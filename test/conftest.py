@@ -0,0 +1,8 @@
+"""Shared setup for the tests. The robot's modules live directly in src, rather
+   than in a package, so we put it on the path.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
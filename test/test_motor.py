@@ -0,0 +1,125 @@
+"""Tests for batching motor commands into frames."""
+
+from typing import Iterator, Sequence
+
+import pytest
+
+import bus
+import motor
+
+@pytest.fixture(name="backend")
+def _backend() -> Iterator[bus.SimulatedBackend]:
+    """Run the shared bus against a simulated board, counting transactions
+       from zero with nothing cached.
+    """
+    assert bus.SCHEDULER is None
+    backend = bus.SimulatedBackend()
+    previous = bus.use(backend)
+    bus.BUS.transactions = 0
+    motor.invalidate()
+    try:
+        yield backend
+    finally:
+        motor.invalidate()
+        bus.use(previous)
+
+def test_frame_is_one_transaction(backend: bus.SimulatedBackend) -> None:
+    with motor.MotorFrame():
+        motor.set_motor(0, 100)
+        motor.set_motor(1, -100)
+        motor.stop_motor(2)
+        assert bus.BUS.transactions == 0
+
+    assert bus.BUS.transactions == 1
+    assert backend.speeds[:3] == [100, -100, 0]
+
+def test_later_commands_replace_earlier(backend: bus.SimulatedBackend) -> None:
+    with motor.MotorFrame() as frame:
+        motor.set_motor(0, 100)
+        motor.set_motor(0, 50)
+        assert len(frame.commands) == 1
+
+    assert bus.BUS.transactions == 1
+    assert backend.speeds[0] == 50
+
+def test_unchanged_commands_are_skipped(backend: bus.SimulatedBackend) -> None:
+    motor.set_motor(0, 100)
+    motor.set_motor(0, 100)
+    with motor.MotorFrame():
+        motor.set_motor(0, 100)
+    assert bus.BUS.transactions == 1
+
+    # Only the changed motor goes out, still in one transaction.
+    with motor.MotorFrame() as frame:
+        motor.set_motor(0, 100)
+        motor.set_motor(1, 100)
+        assert len(frame.commands) == 2
+    assert bus.BUS.transactions == 2
+    assert backend.speeds[:2] == [100, 100]
+
+def test_nested_frames_join_the_outer_one(backend: bus.SimulatedBackend) -> None:
+    with motor.MotorFrame() as outer:
+        motor.set_motor(0, 100)
+        with motor.MotorFrame():
+            motor.set_motor(0, 20)
+            motor.set_motor(1, 30)
+        assert bus.BUS.transactions == 0
+        assert len(outer.commands) == 2
+
+    assert bus.BUS.transactions == 1
+    assert backend.speeds[:2] == [20, 30]
+
+def test_stop_motors_forces_a_resend(backend: bus.SimulatedBackend) -> None:
+    motor.stop_motor(0)
+    motor.stop_motor(0)
+    assert bus.BUS.transactions == 1
+
+    # Sent even though the board should already hold these commands.
+    motor.stop_motors()
+    motor.stop_motors()
+    assert bus.BUS.transactions == 3
+
+    # And it replaces the cached commands, so stopping again is skipped.
+    motor.stop_motor(0)
+    assert bus.BUS.transactions == 3
+
+    motor.set_motor(0, 100)
+    assert bus.BUS.transactions == 4
+    assert backend.speeds[0] == 100
+
+class FailingBackend(bus.SimulatedBackend):
+    """A board which fails every write."""
+
+    def write(self, address: int, blocks: Sequence[Sequence[int]]) -> None:
+        raise IOError("Remote I/O error")
+
+def test_failed_writes_are_not_cached(backend: bus.SimulatedBackend) -> None:
+    bus.use(FailingBackend())
+    with pytest.raises(IOError):
+        motor.set_motor(0, 100)
+
+    # The retry is sent, rather than skipped as already held by the board.
+    bus.use(backend)
+    motor.set_motor(0, 100)
+    assert backend.speeds[0] == 100
+
+def test_discarded_writes_are_not_cached(backend: bus.SimulatedBackend) -> None:
+    scheduler = bus.Scheduler(bus.BUS)
+    bus.SCHEDULER = scheduler
+    try:
+        motor.set_motor(0, 100)
+        motor.stop_motors()
+        motor.set_motor(1, 100)
+
+        # The stop jumps the queue, and the write before it is discarded.
+        for _ in range(3):
+            batch = scheduler._next() # pylint: disable=protected-access
+            if batch:
+                scheduler._execute(batch) # pylint: disable=protected-access
+        assert scheduler.discarded == 1
+        assert backend.speeds[:2] == [0, 100]
+    finally:
+        bus.SCHEDULER = None
+
+    motor.set_motor(0, 100)
+    assert backend.speeds[0] == 100